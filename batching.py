@@ -0,0 +1,121 @@
+"""
+Batch assembly from the uint16 token files of data/<dataset>. BatchBuilder opens the memmap once
+and sees it as a (len - block_size, block_size + 1) strided view of all the windows, without
+copying. A batch is gathered with a single np.take of the sampled rows into a persistent uint16
+buffer. It crosses to the device as 16 bit and is only widened to int64 there. x and y are the
+first and the last block_size columns of the same gathered rows, so y is a view shifted by one.
+Without a sampler the window starts are drawn at random like before. With an EpochSampler every
+epoch visits each of the non-overlapping windows once, split disjointly between the DDP ranks.
+"""
+import numpy as np
+import torch
+
+def _mix(x):
+    # the splitmix64 finalizer, a cheap bijective hash of a uint64 array (the products wrap around)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _permute(i, n, key, rounds=4):
+    """ the elements at positions i (an array) of a pseudo-random permutation of range(n) chosen by key """
+    # a feistel network permutes [0, 4**half) for any round function, values that land outside
+    # [0, n) are permuted again until they're inside (cycle walking), which is less than 4 rounds on average
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    h, mask = np.uint64(half), np.uint64((1 << half) - 1)
+    round_keys = _mix(np.arange(rounds, dtype=np.uint64) + np.uint64(key))
+    x = np.asarray(i, dtype=np.uint64).copy()
+    todo = np.ones(x.shape, dtype=bool)
+    while todo.any():
+        l, r = x[todo] >> h, x[todo] & mask
+        for k in round_keys:
+            l, r = r, l ^ (_mix(r ^ k) & mask)
+        x[todo] = (l << h) | r
+        todo = x >= n
+    return x.astype(np.int64)
+
+class EpochSampler:
+    """
+    Window starts for BatchBuilder: the (num_tokens - 1) // block_size windows that start at
+    multiples of block_size, in a new seeded order every epoch. Position j of an epoch belongs to
+    rank j % world_size, so the ranks see disjoint windows. Batch k is computed on demand from
+    (seed, epoch, k), nothing of the size of the dataset is ever built, and the cursor that a
+    resumed run continues from is just the number of batches already trained on.
+    """
+
+    def __init__(self, num_tokens, block_size, batch_size, seed, rank=0, world_size=1):
+        self.num_windows = (num_tokens - 1) // block_size # window i is tokens [i*block_size, (i+1)*block_size]
+        self.block_size, self.batch_size = block_size, batch_size
+        self.seed, self.rank, self.world_size = seed, rank, world_size
+        self.batches_per_epoch = self.num_windows // world_size // batch_size # the remainder is left out of each epoch
+        assert self.batches_per_epoch > 0, "not enough windows for one batch per rank"
+        self.start = 0 # batches trained on before this run
+
+    def offsets(self, k):
+        """ the window starts of batch k of this run on this rank """
+        epoch, b = divmod(self.start + k, self.batches_per_epoch)
+        j = np.arange(b * self.batch_size, (b + 1) * self.batch_size) * self.world_size + self.rank
+        key = (self.seed * 0x9E3779B97F4A7C15 + epoch) % 2**64
+        return _permute(j, self.num_windows, key) * self.block_size
+
+    def epoch(self, batches):
+        """ fractional epoch after this run has trained on batches batches """
+        return (self.start + batches) / self.batches_per_epoch
+
+    def state_dict(self, batches):
+        return {'batches': self.start + batches, 'seed': self.seed, 'world_size': self.world_size}
+
+    def load_state_dict(self, state):
+        self.start = state['batches']
+        if state['seed'] != self.seed or state['world_size'] != self.world_size:
+            print(f"resuming the epoch sampler with a different seed or world size, the rest of epoch {int(self.epoch(0))} is reshuffled")
+
+class BatchBuilder:
+
+    def __init__(self, path, batch_size, block_size, device, slots=2, sampler=None):
+        self.data = np.memmap(path, dtype=np.uint16, mode='r')
+        self.windows = np.lib.stride_tricks.sliding_window_view(self.data, block_size + 1) # a view, nothing is read
+        self.batch_size, self.block_size = batch_size, block_size
+        self.device = device
+        self.cuda = 'cuda' in str(device)
+        # the batch of a slot stays valid until `slots` more batches have been built, two cover a
+        # training loop that fetches the next batch between the forward and the backward
+        self.slots = [self._slot() for _ in range(slots)]
+        self.sampler = sampler # sampler batches must only be drawn by the training stream, every draw moves its cursor
+        self.k = 0 # batches built so far
+
+    def _slot(self):
+        shape = (self.batch_size, self.block_size + 1)
+        # torch has no uint16 everywhere, the buffers hold the uint16 bits as int16
+        host = torch.empty(shape, dtype=torch.int16, pin_memory=self.cuda)
+        staged = torch.empty(shape, dtype=torch.int16, device=self.device) if self.cuda else host
+        out = torch.empty(shape, dtype=torch.int64, device=self.device)
+        event = torch.cuda.Event() if self.cuda else None
+        return host, staged, out, event
+
+    def sample(self, generator=None, k=None):
+        """
+        window starts of batch k (by default the next one) from the sampler, or without one random
+        ones drawn like torch.randint(len(data) - block_size, (batch_size,))
+        """
+        if self.sampler is not None:
+            return self.sampler.offsets(self.k if k is None else k)
+        return torch.randint(len(self.windows), (self.batch_size,), generator=generator).numpy()
+
+    def gather(self, ix, out):
+        """ reads the windows starting at ix into out, a (batch_size, block_size + 1) uint16 array """
+        # mode='clip' writes straight into out, the default 'raise' goes through a temporary buffer
+        np.take(self.windows, ix, axis=0, out=out, mode='clip')
+        return out
+
+    def __call__(self, generator=None):
+        """ the next (x, y) batch on device, x and y are views into a buffer the builder reuses """
+        host, staged, out, event = self.slots[self.k % len(self.slots)]
+        if event is not None:
+            event.synchronize() # the last copy out of host has finished
+        self.gather(self.sample(generator), host.numpy().view(np.uint16))
+        self.k += 1
+        if self.cuda:
+            staged.copy_(host, non_blocking=True)
+            event.record()
+        out.copy_(staged).bitwise_and_(0xFFFF) # int16 -> int64 sign extends, the mask restores the uint16 value
+        return out[:, :-1], out[:, 1:]
@@ -2,17 +2,30 @@
 A much shorter version of train.py for benchmarking
 """
 import os
+import pickle
+import resource
 from contextlib import nullcontext
-import numpy as np
 import time
 import torch
 from model import GPTConfig, GPT
+from perf import peak_flops, step_flops, throughput
+from prefetch import PrefetchLoader
+from batching import BatchBuilder
 
 # -----------------------------------------------------------------------------
 batch_size = 12
 block_size = 1024
+n_layer = 12
+n_head = 12
+n_embd = 768
+dropout = 0.0 # 0 for determinism
 bias = False
+activation_checkpointing = 0 # recompute the activations of every k-th Block in backward, 0: none, 1: all
+loss_chunk_size = 0 # > 0: fused lm_head + cross-entropy over chunks of this many positions, never builds the full logits
 real_data = True
+prefetch = 0 # > 0: build the batches in background threads, up to this many batches ahead per worker
+prefetch_workers = 1
+dataset = 'openwebtext'
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
@@ -30,29 +43,35 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # data loading init
+# vocab size of the dataset, if it has a meta.pkl
+meta_path = os.path.join('data', dataset, 'meta.pkl')
+vocab_size = 50304
+if os.path.exists(meta_path):
+    with open(meta_path, 'rb') as f:
+        vocab_size = pickle.load(f)['vocab_size']
+synchronize = torch.cuda.synchronize if device_type == 'cuda' else lambda: None
 if real_data:
-    dataset = 'openwebtext'
     data_dir = os.path.join('data', dataset)
-    train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    def get_batch(split):
-        data = train_data # note ignore split in benchmarking script
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        return x, y
+    builder = BatchBuilder(os.path.join(data_dir, 'train.bin'), batch_size, block_size, device)
+    get_batch = lambda split: builder() # note ignore split in benchmarking script
+    if prefetch:
+        loader = PrefetchLoader(os.path.join(data_dir, 'train.bin'), batch_size, block_size, device, seed, prefetch_workers, prefetch)
+        get_batch = lambda split: next(loader)
 else:
     # alternatively, if fixed data is desired to not care about data loading
-    x = torch.randint(50304, (batch_size, block_size), device=device)
-    y = torch.randint(50304, (batch_size, block_size), device=device)
+    x = torch.randint(vocab_size, (batch_size, block_size), device=device)
+    y = torch.randint(vocab_size, (batch_size, block_size), device=device)
     get_batch = lambda split: (x, y)
 
 # model init
 gptconf = GPTConfig(
     block_size = block_size, # how far back does the model look? i.e. context size
-    n_layer = 12, n_head = 12, n_embd = 768, # size of the model
-    dropout = 0, # for determinism
+    n_layer = n_layer, n_head = n_head, n_embd = n_embd, # size of the model
+    vocab_size = vocab_size,
+    dropout = dropout,
     bias = bias,
+    activation_checkpointing = activation_checkpointing,
+    loss_chunk_size = loss_chunk_size,
 )
 model = GPT(gptconf)
 model.to(device)
@@ -96,22 +115,35 @@ if profile:
 else:
 
     # simple benchmarking
-    torch.cuda.synchronize()
+    peak = peak_flops(device, ptdtype if device_type == 'cuda' else torch.float32) # calibrated once per host
+    synchronize()
     for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
         t0 = time.time()
+        data_wait = 0.0
         X, Y = get_batch('train')
         for k in range(num_steps):
             with ctx:
                 logits, loss = model(X, Y)
+            t_data = time.time()
             X, Y = get_batch('train')
+            data_wait += time.time() - t_data
             optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
             lossf = loss.item()
             print(f"{k}/{num_steps} loss: {lossf:.4f}")
-        torch.cuda.synchronize()
+        synchronize()
         t1 = time.time()
         dt = t1-t0
-        mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
+        stats = throughput(gptconf, batch_size, block_size, dt, peak, num_steps)
         if stage == 1:
-            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%")
+            # peak memory of the whole run, on CPU the peak RSS of the process
+            if device_type == 'cuda':
+                peak_memory = torch.cuda.max_memory_allocated()
+            else:
+                peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+            flops = step_flops(gptconf, batch_size, block_size)
+            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, {stats['tokens_per_sec']:.0f} tokens/sec, "
+                  f"{stats['flops_per_sec']/1e12:.3f} TFLOPS of {peak/1e12:.3f} peak, MFU: {stats['mfu']*100:.2f}%, peak memory: {peak_memory/1e6:.2f}MB")
+            print(f"data wait per iteration: {data_wait/num_steps*1000:.4f}ms")
+            print("FLOPs per iteration: " + ", ".join(f"{k} {v/1e9:.1f}G" for k, v in flops.items()))
@@ -0,0 +1,117 @@
+"""
+Blockwise attention (model.BlockwiseAttention, GPTConfig.attn_block_size) against the math path
+CausalSelfAttention falls back to without flash attention, which builds the (T, T) matrix.
+First asserts that outputs and gradients agree with the math path (and SDPA, without dropout) up
+to tol, with and without cached positions before the queries and with attention dropout (the math
+path gets the same per-tile masks), and that a fixed seed reproduces them exactly, then sweeps T: every (mode, T) runs a forward+backward of one attention layer in a fresh
+process, which reports its time and the growth of its peak RSS (or peak CUDA memory) over the inputs.
+Example:
+$ python bench_attention.py
+$ python bench_attention.py --seq_lens=512,1024,2048 --attn_block_size=128
+"""
+import math
+import time
+import resource
+import multiprocessing as mp
+import torch
+from torch.nn import functional as F
+from model import BlockwiseAttention
+
+# -----------------------------------------------------------------------------
+batch_size = 8
+n_head = 12
+head_size = 64
+seq_lens = '256,512,1024,2048' # comma separated
+attn_block_size = 128
+num_iters = 5 # timed forward+backward passes per setting, the mean is reported
+seed = 1337
+tol = 1e-3 # largest abs diff of outputs and gradients to the reference paths the checks accept
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+def math_attention(q, k, v, pos, keep=None):
+    # the manual path of CausalSelfAttention, with the mask for queries at positions pos, pos+1, ..
+    # and optionally the (scaled) dropout mask keep of the attention probabilities
+    T, Tk = q.size(2), k.size(2)
+    att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+    mask = torch.arange(Tk, device=q.device) <= (pos.view(-1, 1, 1, 1) if torch.is_tensor(pos) else torch.arange(pos, pos + T, device=q.device).view(-1, 1))
+    att = F.softmax(att.masked_fill(~mask, float('-inf')), dim=-1)
+    return (att if keep is None else att * keep) @ v
+
+def tile_masks(q, k, dropout, seed):
+    # the dropout masks BlockwiseAttention draws after torch.manual_seed(seed), as one (B, nh, T, Tk) tensor
+    torch.manual_seed(seed)
+    s = int(torch.randint(2**62, (1,)))
+    T, Tk = q.size(2), k.size(2)
+    keep = torch.ones(*q.shape[:2], T, Tk, device=q.device)
+    for i0 in range(0, T, attn_block_size):
+        for j0 in range(0, Tk, attn_block_size):
+            i1, j1 = min(i0 + attn_block_size, T), min(j0 + attn_block_size, Tk)
+            keep[:, :, i0:i1, j0:j1] = BlockwiseAttention._keep(s, i0, j0, Tk, keep[:, :, i0:i1, j0:j1].shape, dropout, q.device)
+    return keep
+
+def check(T, Tk, pos, dropout=0.0):
+    q = torch.randn(2, 4, T, head_size, device=device, requires_grad=True)
+    k = torch.randn(2, 4, Tk, head_size, device=device, requires_grad=True)
+    v = torch.randn(2, 4, Tk, head_size, device=device, requires_grad=True)
+    dy = torch.randn(2, 4, T, head_size, device=device)
+    keep = tile_masks(q, k, dropout, seed) if dropout > 0 else None
+    def blockwise():
+        torch.manual_seed(seed) # the seed of the masks is drawn from the global RNG
+        return BlockwiseAttention.apply(q, k, v, pos, attn_block_size, dropout)
+    fns = [lambda: math_attention(q, k, v, pos, keep), blockwise, blockwise] # blockwise twice: same seed, same masks
+    if dropout == 0 and not torch.is_tensor(pos):
+        # and the SDPA kernel of the flash path, with the offset causal mask
+        mask = torch.arange(Tk, device=device) <= torch.arange(pos, pos + T, device=device).view(-1, 1)
+        fns.append(lambda: F.scaled_dot_product_attention(q, k, v, attn_mask=mask))
+    results = []
+    for fn in fns:
+        y = fn()
+        results.append((y,) + torch.autograd.grad(y, (q, k, v), dy))
+    reference = results[0]
+    assert all(torch.equal(a, b) for a, b in zip(results[1], results[2])), "blockwise attention isn't deterministic for a fixed seed"
+    err = max(max((a - b).abs().max().item() for a, b in zip(reference, other)) for other in results[1:])
+    assert err < tol, f"blockwise attention differs from the reference by {err:.2e} (T={T}, Tk={Tk}, dropout={dropout})"
+    return err
+
+def measure(mode, T, queue):
+    # runs in its own process so that ru_maxrss is the peak of this setting alone
+    torch.manual_seed(seed)
+    q, k, v = (torch.randn(batch_size, n_head, T, head_size, device=device, requires_grad=True) for _ in range(3))
+    dy = torch.randn(batch_size, n_head, T, head_size, device=device)
+    attention = math_attention if mode == 'math' else lambda q, k, v, pos: BlockwiseAttention.apply(q, k, v, pos, attn_block_size)
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.max_memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+    t0 = time.time()
+    for _ in range(num_iters):
+        torch.autograd.grad(attention(q, k, v, 0), (q, k, v), dy)
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put(((time.time() - t0) / num_iters, peak - base))
+
+if __name__ == '__main__':
+    torch.manual_seed(seed)
+    for T, Tk in [(attn_block_size * 3 + 5, attn_block_size * 3 + 5), (attn_block_size + 7, attn_block_size * 3 + 5), (1, attn_block_size * 2 + 3)]:
+        print(f"check T={T:4d} Tk={Tk:4d}: max abs diff to the math path {check(T, Tk, Tk - T):.2e}")
+    pos = torch.randint(0, attn_block_size * 2, (2,), device=device)
+    print(f"check per-row positions: max abs diff to the math path {check(1, attn_block_size * 2, pos):.2e}")
+    T = attn_block_size * 2 + 5
+    print(f"check dropout 0.2: max abs diff to the math path with the same masks {check(T, T, 0, dropout=0.2):.2e}")
+    print(f"check dropout 0.2 with cached positions: max abs diff {check(attn_block_size + 7, T, T - attn_block_size - 7, dropout=0.2):.2e}")
+    ctx = mp.get_context('spawn')
+    for T in [int(T) for T in seq_lens.split(',')]:
+        for mode in ('math', 'blockwise'):
+            queue = ctx.Queue()
+            p = ctx.Process(target=measure, args=(mode, T, queue))
+            p.start()
+            dt, peak = queue.get()
+            p.join()
+            print(f"T {T:5d} {mode:>9s}: {dt*1000:9.2f}ms per forward+backward, peak memory +{peak/1e6:9.2f}MB")
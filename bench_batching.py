@@ -0,0 +1,74 @@
+"""
+Batches/sec of assembling training batches from a token memmap: the old get_batch (a new memmap
+per call, one slice, astype and torch.stack per row) against BatchBuilder (batching.py), on the
+sizes of shakespeare_char and openwebtext train.bin. A dataset without a prepared train.bin is
+stood in for by a sparse file of its size in tmp_dir, so it's only read from the page cache.
+Both draw the same windows from the same seed, which is checked.
+Example:
+$ python bench_batching.py
+$ python bench_batching.py --batch_size=64 --block_size=256 --device=cuda
+"""
+import os
+import time
+import numpy as np
+import torch
+from batching import BatchBuilder
+
+# -----------------------------------------------------------------------------
+datasets = 'shakespeare_char,openwebtext' # comma separated
+batch_size = 12
+block_size = 1024
+num_batches = 500
+tmp_dir = '/tmp' # where the stand-in files of missing datasets go
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+num_tokens = {'shakespeare_char': 1003854, 'openwebtext': 9035582198} # of train.bin, see the prepare.py scripts
+device_type = 'cuda' if 'cuda' in device else 'cpu'
+synchronize = torch.cuda.synchronize if device_type == 'cuda' else lambda: None
+
+def get_batch(path):
+    # get_batch of train.py before batching.py
+    data = np.memmap(path, dtype=np.uint16, mode='r')
+    ix = torch.randint(len(data) - block_size, (batch_size,))
+    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    if device_type == 'cuda':
+        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+    else:
+        x, y = x.to(device), y.to(device)
+    return x, y
+
+def timed(fn):
+    torch.manual_seed(seed)
+    fn() # warmup
+    synchronize()
+    t0 = time.time()
+    for _ in range(num_batches):
+        fn()
+    synchronize()
+    return num_batches / (time.time() - t0)
+
+for dataset in datasets.split(','):
+    path = os.path.join('data', dataset, 'train.bin')
+    stand_in = not os.path.exists(path)
+    if stand_in:
+        path = os.path.join(tmp_dir, f'bench_batching_{dataset}.bin')
+        with open(path, 'wb') as f:
+            f.truncate(2 * num_tokens[dataset]) # sparse, takes no disk space
+    builder = BatchBuilder(path, batch_size, block_size, device)
+    torch.manual_seed(seed)
+    x0, y0 = get_batch(path)
+    torch.manual_seed(seed)
+    x1, y1 = builder()
+    assert torch.equal(x0, x1) and torch.equal(y0, y1), "BatchBuilder drew different batches"
+    old = timed(lambda: get_batch(path))
+    new = timed(builder)
+    tokens = len(builder.data)
+    print(f"{dataset} ({tokens:,} tokens{', sparse stand-in' if stand_in else ''}): get_batch {old:.1f} batches/sec, "
+          f"BatchBuilder {new:.1f} batches/sec, {new/old:.2f}x")
+    del builder
+    if stand_in:
+        os.remove(path)
@@ -0,0 +1,60 @@
+"""
+Compares checkpoint formats for inference hosts, e.g. the fp32 ckpt.pt against the memory-mapped
+ckpt.mmap from export_mmap.py and the weight-only quantized ones from export_quantized.py. Every
+checkpoint is loaded in a fresh process, which reports its load time, peak RSS and val loss on
+data/<dataset>/val.bin, together with the file size.
+Example:
+$ python bench_checkpoint.py --out_dir=out-shakespeare-char --ckpt_names=ckpt.pt,ckpt.mmap,ckpt_int8.pt,ckpt_int4.pt
+"""
+import os
+import time
+import resource
+import multiprocessing as mp
+import numpy as np
+import torch
+
+# -----------------------------------------------------------------------------
+out_dir = 'out'
+ckpt_names = 'ckpt.pt,ckpt.mmap,ckpt_int8.pt,ckpt_int4.pt' # comma separated checkpoint files in out_dir
+dataset = '' # val loss is measured on data/<dataset>/val.bin, defaults to the checkpoint's dataset
+batch_size = 8
+eval_iters = 20 # number of val batches the loss is averaged over
+seed = 1337
+device = 'cpu'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+def measure(ckpt_name, queue):
+    # runs in its own process so that ru_maxrss is the peak of this checkpoint alone
+    from inference import load_model
+    t0 = time.time()
+    model, checkpoint = load_model('resume', out_dir, device, ckpt_name)
+    load_time = time.time() - t0
+    data_dir = os.path.join('data', dataset or checkpoint['config'].get('dataset', 'openwebtext'))
+    data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
+    T = model.config.block_size
+    torch.manual_seed(seed) # the same val batches for every checkpoint
+    losses = []
+    with torch.no_grad():
+        for _ in range(eval_iters):
+            ix = torch.randint(len(data) - T, (batch_size,))
+            x = torch.stack([torch.from_numpy((data[i:i+T]).astype(np.int64)) for i in ix]).to(device)
+            y = torch.stack([torch.from_numpy((data[i+1:i+1+T]).astype(np.int64)) for i in ix]).to(device)
+            losses.append(model(x, y)[1].item())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+    queue.put((load_time, peak_rss, sum(losses) / len(losses)))
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    for ckpt_name in ckpt_names.split(','):
+        path = os.path.join(out_dir, ckpt_name)
+        if not os.path.exists(path):
+            print(f"{ckpt_name:>14s}: not found, skipping")
+            continue
+        queue = ctx.Queue()
+        p = ctx.Process(target=measure, args=(ckpt_name, queue))
+        p.start()
+        load_time, peak_rss, val_loss = queue.get()
+        p.join()
+        print(f"{ckpt_name:>14s}: file {os.path.getsize(path)/1e6:9.2f}MB, load {load_time*1000:9.2f}ms, "
+              f"peak RSS {peak_rss/1e6:9.2f}MB, val loss {val_loss:.4f}")
@@ -0,0 +1,52 @@
+"""
+Cold start and steady state of the ways sample.py can run a checkpoint:
+- eager: the GPT built in Python from ckpt.pt
+- compiled: the same, with torch.compile
+- exported: the torch.export programs of export_program.py (run that first)
+Every mode runs in a fresh process, which reports the time from its launch (interpreter start and
+imports included) to the first sampled token, and the tokens/sec of the decoding after it.
+Example:
+$ python export_program.py --out_dir=out-shakespeare-char
+$ python bench_coldstart.py --out_dir=out-shakespeare-char
+"""
+import time
+import multiprocessing as mp
+
+# -----------------------------------------------------------------------------
+out_dir = 'out'
+modes = 'eager,compiled,exported' # comma separated
+num_samples = 1 # batch size of the generate calls
+prompt_len = 16 # length of the random prompt
+max_new_tokens = 256
+temperature = 1.0
+top_k = 200
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+def measure(mode, t_launch, queue):
+    # runs in its own process, so nothing is loaded or compiled yet
+    import torch
+    from inference import load_model
+    model, _ = load_model('exported' if mode == 'exported' else 'resume', out_dir, device)
+    if mode == 'compiled':
+        model.compile() # compiles the module in place, so the forwards inside generate use it
+    torch.manual_seed(seed)
+    x = torch.randint(model.config.vocab_size, (num_samples, prompt_len), device=device)
+    steps = model.generate_stream(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=True)
+    next(steps)
+    t_first = time.time()
+    n = sum(1 for _ in steps)
+    dt = time.time() - t_first
+    queue.put((t_first - t_launch, num_samples * n / dt if n else 0.0))
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    for mode in modes.split(','):
+        queue = ctx.Queue()
+        p = ctx.Process(target=measure, args=(mode, time.time(), queue))
+        p.start()
+        ttft, tokens_per_sec = queue.get()
+        p.join()
+        print(f"{mode:>9s}: cold start to first token {ttft*1000:9.2f}ms, then {tokens_per_sec:9.2f} tokens/sec")
@@ -0,0 +1,232 @@
+"""
+A short script for benchmarking generation (tokens/sec) on a randomly initialized
+or trained model. The `bench` setting picks what is compared:
+- 'kv_cache': full-context vs cached decoding, also reports how many tokens both sample alike for
+  a fixed seed and asserts that they decode exactly the same greedy tokens
+- 'batched': one generate call per sample (the old sample.py loop) vs all samples
+  as rows of micro-batched generate calls
+- 'speculative': cached generate vs generate_speculative with a draft model (draft_out_dir,
+  or a random one sized by the draft_* args), also reports the draft acceptance rate
+- 'beam': beam search over num_samples prompts with all beams as rows of one batch vs one
+  forward per beam and step, also checks that both find the same completions
+- 'stride': generating past block_size with a window that slides by each of window_strides
+  tokens at a time (see GPT.step_logits), reports tokens/sec and the val loss of the model on
+  data/<dataset>/val.bin when it reads the text through the same sliding window
+- 'prefix_cache': time to first token for prompts made of a shared prompt_len prefix and a
+  unique suffix_len suffix, without and with a PrefixCache
+- 'kv_heads': cached decoding of random models with each of kv_heads key/value heads (grouped-query
+  attention, GPTConfig.n_kv_head), reports tokens/sec, the KV cache memory and the parameter count
+Example:
+$ python bench_generate.py config/train_shakespeare_char.py
+$ python bench_generate.py config/train_gpt2.py --max_new_tokens=200
+$ python bench_generate.py config/train_gpt2.py --bench=batched --num_samples=32 --micro_batch_size=8
+$ python bench_generate.py config/train_shakespeare_char.py --bench=beam --beam_width=8 --num_samples=4 --max_new_tokens=32
+$ python bench_generate.py --bench=stride --init_from=resume --out_dir=out-shakespeare-char --dataset=shakespeare_char --max_new_tokens=1024
+$ python bench_generate.py config/train_gpt2.py --bench=prefix_cache --prompt_len=512
+$ python bench_generate.py config/train_gpt2.py --bench=kv_heads --kv_heads=12,4,2,1 --num_samples=32
+$ python bench_generate.py --bench=speculative --init_from=resume --out_dir=out --draft_out_dir=out_bs64_nl4_nh4_ne128_b8_mi1000_do0.1
+"""
+import os
+import time
+from contextlib import nullcontext
+import numpy as np
+import torch
+from torch.nn import functional as F
+from model import KVCache
+from inference import load_model, init_scratch_model
+from prefix_cache import PrefixCache
+
+# -----------------------------------------------------------------------------
+bench = 'kv_cache' # 'kv_cache', 'batched', 'speculative', 'beam', 'stride', 'prefix_cache' or 'kv_heads', see above
+init_from = 'scratch' # 'scratch' (random weights, sized by the model args below), 'resume' (from out_dir) or a gpt2 variant
+out_dir = 'out' # ignored if init_from is not 'resume'
+dataset = 'openwebtext' # used to look up the vocab size in data/<dataset>/meta.pkl when init_from='scratch'
+n_layer = 12
+n_head = 12
+n_embd = 768
+block_size = 1024
+bias = False
+num_samples = 1 # batch size of the generate calls, or number of samples for bench='batched'
+micro_batch_size = 16 # max rows per generate call for bench='batched'
+draft_out_dir = '' # draft checkpoint for bench='speculative', a random draft sized by the args below if empty
+draft_n_layer = 2
+draft_n_head = 4
+draft_n_embd = 128
+num_draft_tokens = 4
+prompt_len = 16 # length of the random prompt
+beam_width = 4 # for bench='beam'
+window_strides = '1,4,16,64' # comma separated window strides for bench='stride'
+suffix_len = 16 # length of the unique part of each prompt for bench='prefix_cache'
+kv_heads = '12,4,2,1' # comma separated numbers of key/value heads for bench='kv_heads', each must divide n_head
+max_new_tokens = 256
+temperature = 1.0
+top_k = 200
+num_trials = 3 # timed runs per mode, the best one is reported
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'float32' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+synchronize = torch.cuda.synchronize if device_type == 'cuda' else lambda: None
+
+# model
+if init_from == 'scratch':
+    model = init_scratch_model(dataset, device, n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size, bias=bias)
+else:
+    model, _ = load_model(init_from, out_dir, device)
+if compile:
+    print("Compiling model...")
+    model = torch.compile(model) # pytorch 2.0
+vocab_size = model.config.vocab_size
+
+def timed(fn):
+    # returns (result, seconds) of the fastest of num_trials seeded runs of fn
+    best = None
+    for _ in range(num_trials):
+        torch.manual_seed(seed)
+        synchronize()
+        t0 = time.time()
+        with torch.no_grad(), ctx:
+            y = fn()
+        synchronize()
+        dt = time.time() - t0
+        best = (y, dt) if best is None or dt < best[1] else best
+    return best
+
+if bench == 'kv_cache':
+    x = torch.randint(vocab_size, (num_samples, prompt_len), device=device)
+    modes = {
+        'full context': dict(use_kv_cache=False),
+        'kv cache': dict(use_kv_cache=True),
+    }
+    results = {name: timed(lambda: model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, **kwargs))
+               for name, kwargs in modes.items()}
+    reference = results['full context'][0]
+    for name, (y, dt) in results.items():
+        match = (y == reference).float().mean().item()
+        print(f"{name:>14s}: {num_samples * max_new_tokens / dt:9.2f} tokens/sec, {dt*1000:9.2f}ms, tokens matching full context: {match*100:.2f}%")
+    # sampled tokens can drift apart on float rounding, greedy ones (top_k=1) have to be exactly the same
+    with torch.no_grad(), ctx:
+        greedy = {name: model.generate(x, max_new_tokens, top_k=1, **kwargs) for name, kwargs in modes.items()}
+    for name, y in greedy.items():
+        assert torch.equal(y, greedy['full context']), f"{name} doesn't decode the same greedy tokens as full context"
+    print("greedy tokens of all modes match")
+
+elif bench == 'batched':
+    x = torch.randint(vocab_size, (1, prompt_len), device=device)
+    def sample_loop():
+        return [model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=True)
+                for _ in range(num_samples)]
+    def sample_batched():
+        ys = []
+        for k0 in range(0, num_samples, micro_batch_size):
+            n = min(micro_batch_size, num_samples - k0)
+            generators = [torch.Generator(device=device).manual_seed(seed + k0 + k) for k in range(n)]
+            ys.append(model.generate(x.expand(n, -1), max_new_tokens, temperature=temperature, top_k=top_k,
+                                     use_kv_cache=True, generator=generators))
+        return ys
+    for name, fn in [('loop', sample_loop), (f'batched x{micro_batch_size}', sample_batched)]:
+        _, dt = timed(fn)
+        print(f"{name:>14s}: {num_samples} samples in {dt*1000:9.2f}ms, {num_samples * max_new_tokens / dt:9.2f} tokens/sec")
+
+elif bench == 'speculative':
+    if draft_out_dir:
+        draft, _ = load_model('resume', draft_out_dir, device)
+    else:
+        draft = init_scratch_model(dataset, device, n_layer=draft_n_layer, n_head=draft_n_head, n_embd=draft_n_embd, block_size=block_size, bias=bias)
+    x = torch.randint(vocab_size, (1, prompt_len), device=device)
+    stats = {}
+    def sample_speculative():
+        stats.clear()
+        return model.generate_speculative(x, draft, max_new_tokens, num_draft_tokens=num_draft_tokens,
+                                          temperature=temperature, top_k=top_k, stats=stats)
+    for name, fn in [('kv cache', lambda: model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=True)),
+                     (f'speculative k={num_draft_tokens}', sample_speculative)]:
+        _, dt = timed(fn)
+        print(f"{name:>14s}: {max_new_tokens / dt:9.2f} tokens/sec, {dt*1000:9.2f}ms")
+    # with random weights the draft rarely agrees with the target, use trained checkpoints for real numbers
+    print(f"acceptance rate: {stats['accepted'] / max(stats['drafted'], 1) * 100:.2f}%, "
+          f"{max_new_tokens / stats['forwards']:.2f} tokens per target forward")
+
+elif bench == 'beam':
+    x = torch.randint(vocab_size, (num_samples, prompt_len), device=device)
+    def beam_one_by_one():
+        # the same search, without eos_token, but every beam is its own forward of the full context
+        results = []
+        for prompt in x:
+            beams = [(0.0, prompt)]
+            for _ in range(max_new_tokens):
+                cand = torch.cat([score + torch.log_softmax(model(seq[None, -model.config.block_size:])[0][0, -1].float(), dim=-1) for score, seq in beams])
+                top_scores, top_ids = cand.topk(beam_width)
+                beams = [(s, torch.cat((beams[i // vocab_size][1], top_ids.new_tensor([i % vocab_size]))))
+                         for s, i in zip(top_scores.tolist(), top_ids.tolist())]
+            results.append(beams[0][1])
+        return results
+    modes = [
+        ('one by one', beam_one_by_one),
+        ('batched', lambda: model.generate_beam(x, max_new_tokens, beam_width=beam_width, use_kv_cache=False)[0]),
+        ('batched cached', lambda: model.generate_beam(x, max_new_tokens, beam_width=beam_width)[0]),
+    ]
+    results = {name: timed(fn) for name, fn in modes}
+    reference = results['one by one'][0]
+    for name, (ys, dt) in results.items():
+        match = sum(torch.equal(y, r) for y, r in zip(ys, reference)) / len(reference)
+        print(f"{name:>14s}: {num_samples * max_new_tokens / dt:9.2f} tokens/sec, {dt*1000:9.2f}ms, completions matching one by one: {match*100:.2f}%")
+    for name, (ys, _) in results.items():
+        assert all(torch.equal(y, r) for y, r in zip(ys, reference)), f"{name} doesn't find the same completions as one by one"
+
+elif bench == 'stride':
+    x = torch.randint(vocab_size, (num_samples, prompt_len), device=device)
+    # val text twice as long as the context, the loss is measured on its second half
+    data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
+    T = model.config.block_size
+    ix = torch.randint(len(data) - 2 * T, (num_samples,))
+    text = torch.stack([torch.from_numpy((data[i:i+2*T]).astype(np.int64)) for i in ix]).to(device)
+    for stride in [int(s) for s in window_strides.split(',')]:
+        _, dt = timed(lambda: model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=True, window_stride=stride))
+        kv_cache = KVCache(model.config.n_layer, T)
+        with torch.no_grad(), ctx:
+            losses = [F.cross_entropy(model.step_logits(text[:, :t], kv_cache, stride).float(), text[:, t]).item() for t in range(T, 2 * T)]
+        print(f"stride {stride:4d}: {num_samples * max_new_tokens / dt:9.2f} tokens/sec, val loss {sum(losses) / len(losses):.4f}")
+
+elif bench == 'prefix_cache':
+    shared = torch.randint(vocab_size, (1, prompt_len), device=device)
+    prompts = [torch.cat((shared, torch.randint(vocab_size, (1, suffix_len), device=device)), dim=1) for _ in range(max(num_samples, num_trials) + 1)]
+    for name, cache in [('no cache', None), ('prefix cache', PrefixCache())]:
+        # the first prompt only warms the cache up, the others are timed to their first token
+        with torch.no_grad(), ctx:
+            model.generate(prompts[0], 1, temperature=temperature, top_k=top_k, use_kv_cache=True, prefix_cache=cache)
+        ttft = []
+        for x in prompts[1:]:
+            # timed once each, a repeated prompt would hit its own full length in the cache
+            synchronize()
+            t0 = time.time()
+            with torch.no_grad(), ctx:
+                model.generate(x, 1, temperature=temperature, top_k=top_k, use_kv_cache=True, prefix_cache=cache)
+            synchronize()
+            ttft.append(time.time() - t0)
+        stats = f", hits {cache.hits}, misses {cache.misses}" if cache is not None else ""
+        print(f"{name:>14s}: time to first token {sum(ttft) / len(ttft) * 1000:9.2f}ms for {prompt_len}+{suffix_len} token prompts{stats}")
+
+elif bench == 'kv_heads':
+    assert init_from == 'scratch', "bench='kv_heads' builds random models with the model args above"
+    x = torch.randint(vocab_size, (num_samples, prompt_len), device=device)
+    for n_kv_head in [int(n) for n in kv_heads.split(',')]:
+        model = init_scratch_model(dataset, device, n_layer=n_layer, n_head=n_head, n_kv_head=n_kv_head, n_embd=n_embd, block_size=block_size, bias=bias)
+        _, dt = timed(lambda: model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=True))
+        # the cache of the full context, allocated by a prefill
+        kv_cache = KVCache(n_layer, block_size)
+        with torch.no_grad(), ctx:
+            model(x, kv_cache=kv_cache)
+        kv_bytes = sum(t.numel() * t.element_size() for t in kv_cache.k + kv_cache.v)
+        print(f"n_kv_head {n_kv_head:3d}: {num_samples * max_new_tokens / dt:9.2f} tokens/sec, "
+              f"KV cache {kv_bytes/1e6:9.2f}MB for {num_samples}x{block_size} positions, {model.get_num_params()/1e6:.2f}M params")
+
+else:
+    raise ValueError(f"Unknown bench: {bench}")
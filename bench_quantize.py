@@ -0,0 +1,84 @@
+"""
+Validates the int8 dynamically quantized CPU inference path (inference.quantize_model) against
+fp32 on the same weights:
+- val loss on data/<dataset>/val.bin, and the delta int8 - fp32 (only for trained weights, i.e. not
+  with init_from='scratch', where the loss of random weights says nothing about the quantization error)
+- forward latency on a fixed batch, and the speedup
+- resident size of the model: the summed bytes of the live tensors it holds (parameters, buffers
+  and the packed int8 weights), each storage counted once
+Example:
+$ python bench_quantize.py --init_from=resume --out_dir=out-shakespeare-char
+$ python bench_quantize.py config/train_gpt2.py --dataset=shakespeare_char
+"""
+import os
+import time
+import numpy as np
+import torch
+from inference import load_model, init_scratch_model, quantize_model
+
+# -----------------------------------------------------------------------------
+init_from = 'scratch' # 'scratch' (random weights, sized by the model args below), 'resume' (from out_dir) or a gpt2 variant
+out_dir = 'out' # ignored if init_from is not 'resume'
+dataset = 'shakespeare_char' # val loss is measured on data/<dataset>/val.bin
+n_layer = 12
+n_head = 12
+n_embd = 768
+block_size = 1024
+bias = False
+batch_size = 4
+eval_iters = 20 # number of val batches the loss is averaged over
+num_trials = 3 # timed forwards per mode, the best one is reported
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+device = 'cpu' # dynamic quantization only runs on CPU
+torch.manual_seed(seed)
+
+def build():
+    # a fresh copy of the fp32 model, quantize_model works in place
+    torch.manual_seed(seed)
+    if init_from == 'scratch':
+        return init_scratch_model(dataset, device, n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size, bias=bias)
+    model, _ = load_model(init_from, out_dir, device)
+    return model
+
+def model_bytes(model):
+    # bytes of the tensors the model keeps alive, the packed int8 weights of the quantized linears
+    # aren't parameters, and the tied wte/lm_head weight is only counted once
+    tensors = list(model.parameters()) + list(model.buffers())
+    for m in model.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            tensors += [t for t in m._packed_params._weight_bias() if t is not None]
+    return sum({t.data_ptr(): t.numel() * t.element_size() for t in tensors}.values())
+
+# the same val batches for both models
+data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
+fp32 = build()
+T = min(block_size, fp32.config.block_size)
+ix = torch.randint(len(data) - T, (eval_iters, batch_size))
+batches = [(torch.stack([torch.from_numpy((data[i:i+T]).astype(np.int64)) for i in row]),
+            torch.stack([torch.from_numpy((data[i+1:i+1+T]).astype(np.int64)) for i in row])) for row in ix]
+assert int(data.max()) < fp32.config.vocab_size, f"{dataset} tokens don't fit the model's vocab, pick a matching dataset"
+
+results = {}
+for name, model in [('fp32', fp32), ('int8', quantize_model(build()))]:
+    with torch.no_grad():
+        val_loss = sum(model(X, Y)[1].item() for X, Y in batches) / len(batches)
+        X = batches[0][0]
+        best = None
+        for _ in range(num_trials):
+            t0 = time.time()
+            model(X)
+            dt = time.time() - t0
+            best = dt if best is None or dt < best else best
+    results[name] = (val_loss, best, model_bytes(model))
+    loss_str = f"val loss {val_loss:.4f}, " if init_from != 'scratch' else ""
+    print(f"{name}: {loss_str}forward {best*1000:.2f}ms, model memory {results[name][2]/1e6:.2f}MB")
+
+(loss_fp32, dt_fp32, mem_fp32), (loss_int8, dt_int8, mem_int8) = results['fp32'], results['int8']
+if init_from != 'scratch':
+    print(f"val loss delta (int8 - fp32): {loss_int8 - loss_fp32:+.4f}")
+else:
+    print("random weights (init_from='scratch'), no val loss comparison, use --init_from=resume or a gpt2 variant for it")
+print(f"speedup: {dt_fp32 / dt_int8:.2f}x, memory reduction: {mem_fp32 / mem_int8:.2f}x")
@@ -0,0 +1,66 @@
+"""
+Microbenchmark of the sampling step alone (sampling.py) on random logits, for a range of batch
+sizes. Compares the old generate() step (boolean mask over the whole vocab, then softmax and
+multinomial over the whole vocab) against the sampling engine with the same top_k, and reports
+the engine with per-row top_k/top_p and with penalties on top. The two top_k steps draw differently
+from the same seed, so it's their distributions that are asserted to match.
+Example:
+$ python bench_sampling.py
+$ python bench_sampling.py --vocab_size=65 --top_k=20 --batch_sizes=1,16,64
+"""
+import time
+import torch
+from torch.nn import functional as F
+from sampling import sample, sampling_probs, token_counts
+
+# -----------------------------------------------------------------------------
+vocab_size = 50304
+batch_sizes = '1,4,16,64,256' # comma separated
+top_k = 200
+top_p = 0.9
+context_len = 256 # length of the random context the penalties are counted over
+num_iters = 50 # timed sampling steps per setting, the mean is reported
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+synchronize = torch.cuda.synchronize if 'cuda' in device else lambda: None
+
+def masked_full_vocab_probs(logits):
+    # the sampling step generate() used to do, up to the draw
+    logits = logits / 0.8
+    v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+    logits[logits < v[:, [-1]]] = -float('Inf')
+    return F.softmax(logits, dim=-1)
+
+def masked_full_vocab(logits):
+    return torch.multinomial(masked_full_vocab_probs(logits), num_samples=1)
+
+def timed(fn, logits):
+    fn(logits.clone()) # warmup
+    synchronize()
+    t0 = time.time()
+    for _ in range(num_iters):
+        fn(logits.clone())
+    synchronize()
+    return (time.time() - t0) / num_iters
+
+for b in [int(b) for b in batch_sizes.split(',')]:
+    logits = torch.randn(b, vocab_size, device=device) * 3
+    # every row with its own parameters, spread around the scalar settings
+    row_top_k = torch.randint(top_k // 2, top_k + 1, (b,), device=device)
+    row_top_p = torch.rand(b, device=device) * (1 - top_p) + top_p
+    diff = (sampling_probs(logits, 0.8, top_k) - masked_full_vocab_probs(logits.clone())).abs().max().item()
+    assert diff < 1e-5, f"the engine's top_k distribution differs from the masked full vocab one by {diff:.2e}"
+    counts = token_counts(torch.randint(vocab_size, (b, context_len), device=device), vocab_size)
+    modes = [
+        ('masked full vocab', masked_full_vocab),
+        ('engine top_k', lambda l: sample(l, 0.8, top_k)),
+        ('engine per-row top_k/top_p', lambda l: sample(l, 0.8, row_top_k, row_top_p)),
+        ('engine + penalties', lambda l: sample(l, 0.8, row_top_k, row_top_p, counts, repetition_penalty=1.2, frequency_penalty=0.5)),
+    ]
+    for name, fn in modes:
+        dt = timed(fn, logits)
+        print(f"batch {b:4d} {name:>27s}: {dt*1e3:8.3f}ms per step, {dt*1e6/b:8.2f}us per row")
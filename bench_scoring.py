@@ -0,0 +1,58 @@
+"""
+Sequences/sec of scoring.score on random sequences of random lengths, one sequence per forward
+against length-bucketed batches of a few sizes, and the largest difference of the batched
+log-likelihoods to the one-at-a-time ones, which has to stay below tol (batching should only change
+them by float rounding).
+Example:
+$ python bench_scoring.py
+$ python bench_scoring.py --init_from=resume --out_dir=out-shakespeare-char --batch_tokens=1024,8192
+"""
+import time
+import torch
+from inference import load_model, init_scratch_model
+from scoring import score
+
+# -----------------------------------------------------------------------------
+init_from = 'scratch' # 'scratch' (random weights, sized by the model args below), 'resume' (from out_dir) or a gpt2 variant
+out_dir = 'out' # ignored if init_from is not 'resume'
+dataset = 'shakespeare_char' # used to look up the vocab size in data/<dataset>/meta.pkl when init_from='scratch'
+n_layer = 6
+n_head = 6
+n_embd = 384
+block_size = 256
+bias = False
+num_sequences = 256
+min_len = 16 # the sequence lengths are uniform in [min_len, max_len]
+max_len = 256
+batch_tokens = '2048,8192,32768' # comma separated, the batched settings to compare against one sequence per forward
+tol = 1e-3 # largest logprob difference of a batched setting to one per forward that passes
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+synchronize = torch.cuda.synchronize if 'cuda' in device else lambda: None
+if init_from == 'scratch':
+    model = init_scratch_model(dataset, device, n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size, bias=bias)
+else:
+    model, _ = load_model(init_from, out_dir, device)
+lengths = torch.randint(min_len, max_len + 1, (num_sequences,)).tolist()
+sequences = [torch.randint(model.config.vocab_size, (n,)).tolist() for n in lengths]
+
+def timed(n_tokens):
+    score(model, sequences[:4], batch_tokens=n_tokens) # warmup
+    synchronize()
+    t0 = time.time()
+    _, logprobs, _ = score(model, sequences, batch_tokens=n_tokens)
+    synchronize()
+    return logprobs, time.time() - t0
+
+# batch_tokens=1 puts every piece into a batch of its own
+reference, dt = timed(1)
+print(f"{'one per forward':>18s}: {num_sequences/dt:9.2f} sequences/sec")
+for n_tokens in [int(n) for n in batch_tokens.split(',')]:
+    logprobs, dt = timed(n_tokens)
+    diff = (logprobs - reference).abs().max().item()
+    print(f"{f'batch_tokens {n_tokens}':>18s}: {num_sequences/dt:9.2f} sequences/sec, max logprob diff {diff:.2e}")
+    assert diff < tol, f"batch_tokens {n_tokens} changes the logprobs by {diff:.2e}"
@@ -0,0 +1,104 @@
+"""
+Load generator for continuous batching (scheduler.py, as used by server.py). Replays the
+same stream of requests, arriving as a Poisson process, against
+- serial: one request at a time with GPT.generate (cached), the rest queue up FIFO
+- continuous: the continuous batching scheduler
+and reports p50/p99 latency (arrival to last token) and aggregate tokens/sec. Example:
+$ python bench_server.py config/train_shakespeare_char.py --num_requests=64 --request_rate=20
+"""
+import time
+import random
+import threading
+from contextlib import nullcontext
+import numpy as np
+import torch
+from inference import load_model, init_scratch_model
+from scheduler import Request, Scheduler
+
+# -----------------------------------------------------------------------------
+init_from = 'scratch' # 'scratch' (random weights, sized by the model args below), 'resume' (from out_dir) or a gpt2 variant
+out_dir = 'out' # ignored if init_from is not 'resume'
+dataset = 'openwebtext' # used to look up the vocab size in data/<dataset>/meta.pkl when init_from='scratch'
+n_layer = 12
+n_head = 12
+n_embd = 768
+block_size = 1024
+bias = False
+num_requests = 64
+request_rate = 10.0 # mean arrivals per second, 0 means all requests arrive at once
+min_prompt_len = 8
+max_prompt_len = 64
+min_new_tokens = 16
+max_new_tokens = 128
+max_batch_size = 16
+temperature = 0.8
+top_k = 200
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'float32' # 'float32' or 'bfloat16' or 'float16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+# model
+if init_from == 'scratch':
+    model = init_scratch_model(dataset, device, n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size, bias=bias)
+else:
+    model, _ = load_model(init_from, out_dir, device)
+vocab_size = model.config.vocab_size
+
+# the request stream: (arrival offset in seconds, prompt, max_new_tokens)
+rng = random.Random(seed)
+t_arrival, workload = 0.0, []
+for i in range(num_requests):
+    t_arrival += rng.expovariate(request_rate) if request_rate > 0 else 0.0
+    prompt = [rng.randrange(vocab_size) for _ in range(rng.randint(min_prompt_len, max_prompt_len))]
+    workload.append((t_arrival, prompt, rng.randint(min_new_tokens, max_new_tokens)))
+
+def make_request(i):
+    _, prompt, n = workload[i]
+    return Request(prompt=list(prompt), max_new_tokens=n, temperature=temperature, top_k=top_k, seed=seed + i)
+
+def bench_serial():
+    t0 = time.time()
+    reqs = []
+    with torch.no_grad(), ctx:
+        for i, (arrival, _, _) in enumerate(workload):
+            time.sleep(max(0.0, t0 + arrival - time.time())) # idle until the next request arrives
+            req = make_request(i)
+            req.t_submit = t0 + arrival
+            x = torch.tensor([req.prompt], dtype=torch.long, device=device)
+            g = torch.Generator(device=device).manual_seed(req.seed)
+            y = model.generate(x, req.max_new_tokens, temperature=req.temperature, top_k=req.top_k, use_kv_cache=True, generator=[g])
+            req.tokens = y[0, len(req.prompt):].tolist()
+            req.t_done = time.time()
+            reqs.append(req)
+    return reqs
+
+def bench_continuous():
+    scheduler = Scheduler(model, max_batch_size=max_batch_size)
+    stop = threading.Event()
+    worker = threading.Thread(target=scheduler.run, args=(stop, ctx), daemon=True)
+    worker.start()
+    t0 = time.time()
+    reqs = []
+    for i, (arrival, _, _) in enumerate(workload):
+        time.sleep(max(0.0, t0 + arrival - time.time()))
+        reqs.append(scheduler.submit(make_request(i)))
+    for req in reqs:
+        req.done.wait()
+    stop.set()
+    worker.join()
+    return reqs
+
+for name, fn in [('serial', bench_serial), ('continuous', bench_continuous)]:
+    reqs = fn()
+    latency = np.array([r.t_done - r.t_submit for r in reqs]) * 1000
+    wall = max(r.t_done for r in reqs) - min(r.t_submit for r in reqs)
+    tokens = sum(len(r.tokens) for r in reqs)
+    print(f"{name:>10s}: latency p50 {np.percentile(latency, 50):9.2f}ms, p99 {np.percentile(latency, 99):9.2f}ms, "
+          f"{tokens / wall:9.2f} tokens/sec ({tokens} tokens in {wall:.2f}s)")
@@ -0,0 +1,57 @@
+"""
+Converts a checkpoint to grouped-query attention (GPTConfig.n_kv_head) for uptraining: the key and
+value heads of every layer are mean-pooled over groups of n_head // n_kv_head consecutive heads,
+the query heads and all other weights are kept. The result is written as ckpt.pt into new_out_dir
+without optimizer state and with iter_num 0, so train.py --init_from=resume starts a fresh
+optimizer (and learning rate warmup) on it.
+Example:
+$ python convert_gqa.py --out_dir=out-shakespeare-char --new_out_dir=out-shakespeare-char-gqa2 --n_kv_head=2
+$ python train.py config/train_shakespeare_char.py --out_dir=out-shakespeare-char-gqa2 --init_from=resume
+"""
+import os
+import torch
+import torch.nn as nn
+from inference import load_model
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # read the checkpoint from here if init_from is 'resume'
+new_out_dir = 'out-gqa' # the converted ckpt.pt is written here
+n_kv_head = 1 # key/value heads per layer after the conversion, 1: multi-query attention
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+model, checkpoint = load_model(init_from, out_dir, 'cpu')
+cfg = model.config
+old_kv_head = cfg.n_kv_head or cfg.n_head
+assert old_kv_head % n_kv_head == 0, f"n_kv_head={n_kv_head} must divide the {old_kv_head} key/value heads of the checkpoint"
+group, hs = old_kv_head // n_kv_head, cfg.head_size or cfg.n_embd // cfg.n_head
+
+def pool(w):
+    # w holds the rows (or bias entries) of old_kv_head heads of hs each, average groups of consecutive heads
+    return w.view(n_kv_head, group, hs, *w.shape[1:]).mean(dim=1).reshape(n_kv_head * hs, *w.shape[1:])
+
+state_dict = {k: v.clone() for k, v in model.state_dict().items() if not k.endswith('.attn.bias')} # causal mask buffer
+for i, block in enumerate(model.transformer.h):
+    assert isinstance(block.attn.c_attn, nn.Linear), "quantized checkpoints can't be converted"
+    for name in ('weight', 'bias'):
+        key = f'transformer.h.{i}.attn.c_attn.{name}'
+        if key in state_dict:
+            q, k, v = state_dict[key].split([block.attn.q_dim, block.attn.kv_dim, block.attn.kv_dim])
+            state_dict[key] = torch.cat([q, pool(k), pool(v)])
+# the two names of the tied weight are saved as one tensor again
+state_dict['transformer.wte.weight'] = state_dict['lm_head.weight']
+
+model_args = dict(checkpoint['model_args'], n_kv_head=n_kv_head)
+export = {
+    'model': state_dict,
+    'model_args': model_args,
+    'iter_num': 0,
+    'best_val_loss': 1e9,
+    'config': checkpoint.get('config', {}),
+}
+os.makedirs(new_out_dir, exist_ok=True)
+path = os.path.join(new_out_dir, 'ckpt.pt')
+torch.save(export, path)
+kv_bytes = 2 * cfg.n_layer * n_kv_head * hs * 4
+print(f"wrote {path}: n_kv_head {old_kv_head} -> {n_kv_head}, KV cache {kv_bytes} bytes per position in fp32 (was {kv_bytes * group})")
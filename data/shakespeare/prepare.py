@@ -1,4 +1,6 @@
 import os
+import sys
+import pickle
 import requests
 import tiktoken
 import numpy as np
@@ -26,6 +28,22 @@ print(f"val has {len(val_ids):,} tokens")
 # export to bin files
 train_ids = np.array(train_ids, dtype=np.uint16)
 val_ids = np.array(val_ids, dtype=np.uint16)
+
+# compact the vocab to the GPT-2 ids that actually occur, most of the 50257 never do in this corpus.
+# meta.pkl maps the compact ids back (token_ids[i] is the GPT-2 id of compact id i), train.py and sample.py
+# encode/decode through it. Run with --full_vocab to keep the plain GPT-2 ids (and no meta.pkl) instead
+meta_path = os.path.join(os.path.dirname(__file__), 'meta.pkl')
+if '--full_vocab' not in sys.argv:
+    counts = np.bincount(np.concatenate([train_ids, val_ids]), minlength=enc.n_vocab)
+    token_ids = np.flatnonzero(counts)
+    remap = np.zeros(enc.n_vocab, dtype=np.uint16)
+    remap[token_ids] = np.arange(len(token_ids), dtype=np.uint16)
+    train_ids, val_ids = remap[train_ids], remap[val_ids]
+    print(f"compacted the vocab to the {len(token_ids):,} ids in use")
+    with open(meta_path, 'wb') as f:
+        pickle.dump({'vocab_size': len(token_ids), 'tokenizer': 'gpt2', 'token_ids': token_ids.tolist()}, f)
+elif os.path.exists(meta_path):
+    os.remove(meta_path)
 train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
 val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
 
@@ -0,0 +1,76 @@
+"""
+Knowledge distillation loss for train.py: the student is trained on a mix of the usual
+cross-entropy and the KL divergence to the softened distribution of a teacher GPT run on the same
+batch. The logits of both models are only formed for chunks of positions, like ChunkedCrossEntropy
+in model.py: the loss is a scalar, so the gradients of the student's final hidden states and
+lm_head weight are computed chunk by chunk in the forward, and each chunk of teacher logits is used
+once and dropped. Neither (b*t, vocab_size) logits tensor is ever held, and neither vocab
+projection is recomputed in backward.
+The teacher has to use the same tokenizer. With different vocab sizes (e.g. the padded 50304 of a
+student against 50257 of gpt2) the KL is taken over the shared first ids.
+"""
+import torch
+from torch.nn import functional as F
+
+class DistillationLoss(torch.autograd.Function):
+    """
+    (loss, ce) of distillation_loss for x (N, C) the student's final hidden states, weight (V, C)
+    its lm_head weight, teacher_x (N, C') the teacher's, targets (N,). ce is only for logging.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, teacher_x, targets, teacher_lm_head, temperature, alpha, chunk):
+        needs_grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+        valid = targets != -1
+        n = valid.sum()
+        ce = torch.zeros((), device=x.device)
+        kl = torch.zeros((), device=x.device)
+        dx = torch.zeros(x.shape, device=x.device) if needs_grad else None
+        dw = torch.zeros(weight.shape, device=weight.device) if needs_grad else None
+        for i in range(0, x.size(0), chunk):
+            xi, ti, vi = x[i:i+chunk], targets[i:i+chunk], valid[i:i+chunk].unsqueeze(1)
+            logits = (xi @ weight.t()).float()
+            teacher_logits = teacher_lm_head(teacher_x[i:i+chunk]).float()
+            V = min(logits.size(-1), teacher_logits.size(-1))
+            log_probs = F.log_softmax(logits, dim=-1)
+            ce += -(log_probs.gather(1, ti.clamp(min=0).unsqueeze(1)) * vi).sum()
+            log_p = F.log_softmax(logits[:, :V] / temperature, dim=-1)
+            log_q = F.log_softmax(teacher_logits[:, :V] / temperature, dim=-1)
+            q = log_q.exp()
+            kl += ((q * (log_q - log_p)).sum(dim=-1, keepdim=True) * vi).sum()
+            if needs_grad:
+                # d/dlogits of the summed losses: softmax - onehot(target) for the cross-entropy and
+                # (softmax(logits / T) - q) / T on the shared ids for the KL, zero for ignored rows
+                dce = log_probs.exp_()
+                dce.scatter_add_(1, ti.clamp(min=0).unsqueeze(1), -torch.ones_like(dce[:, :1]))
+                dlogits = (1 - alpha) * dce
+                dlogits[:, :V] += alpha * temperature * (log_p.exp() - q) # temperature**2 * (p - q) / temperature
+                dlogits *= vi
+                dx[i:i+chunk] = dlogits.to(weight.dtype) @ weight
+                dw += (dlogits.t().to(xi.dtype) @ xi).float()
+            del logits, teacher_logits
+        ce, kl = ce / n, kl / n
+        # temperature**2 keeps the gradient scale of the soft targets independent of the temperature
+        loss = (1 - alpha) * ce + alpha * temperature ** 2 * kl
+        if needs_grad:
+            ctx.save_for_backward((dx / n).to(x.dtype), (dw / n).to(weight.dtype))
+        ctx.mark_non_differentiable(ce)
+        return loss, ce
+
+    @staticmethod
+    def backward(ctx, dloss, dce):
+        dx, dw = ctx.saved_tensors
+        return dx * dloss.to(dx.dtype), dw * dloss.to(dw.dtype), None, None, None, None, None, None
+
+def distillation_loss(model, lm_head, teacher, idx, targets, temperature=2.0, alpha=0.5, chunk_size=1024):
+    """
+    Returns (loss, ce): loss = (1 - alpha) * cross-entropy + alpha * temperature**2 * KL to the
+    teacher at temperature, both averaged over the targets that aren't -1, and the cross-entropy alone.
+    model is called like in training (it may be wrapped in DDP or compiled), lm_head is its
+    lm_head module, teacher a GPT in eval mode.
+    """
+    hidden, _ = model(idx, return_hidden=True)
+    with torch.no_grad():
+        teacher_hidden, _ = teacher(idx, return_hidden=True)
+    return DistillationLoss.apply(hidden.reshape(-1, hidden.size(-1)), lm_head.weight, teacher_hidden.reshape(-1, teacher_hidden.size(-1)),
+                                  targets.reshape(-1), teacher.lm_head, temperature, alpha, chunk_size)
@@ -0,0 +1,37 @@
+"""
+Exports the ckpt.pt of a training run into the inference-only, memory-mapped ckpt.mmap next to it
+(see mmap_ckpt.py): only the weights, optionally downcast, plus model_args, config and the dataset
+meta. sample.py, run_sampling.py and train.py --eval_only=True pick it up automatically while it is
+newer than ckpt.pt.
+Example:
+$ python export_mmap.py --out_dir=out-shakespeare-char --dtype=bfloat16
+"""
+import os
+import pickle
+import torch
+from inference import load_model
+from mmap_ckpt import save_mmap_checkpoint
+
+# -----------------------------------------------------------------------------
+out_dir = 'out'
+dtype = 'float32' # 'float32', 'bfloat16' or 'float16', the dtype the weights are stored (and later run) in
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+model, checkpoint = load_model('resume', out_dir, 'cpu', 'ckpt.pt')
+state_dict = {k: v for k, v in model.state_dict().items() if not k.endswith('.attn.bias')} # causal mask buffer
+header = {k: checkpoint.get(k) for k in ('model_args', 'config', 'iter_num', 'best_val_loss')}
+header['best_val_loss'] = float(header['best_val_loss']) if header['best_val_loss'] is not None else None
+# keep the tokenizer of char-level datasets with the weights, so the file is all sample.py needs
+meta_path = os.path.join('data', (checkpoint.get('config') or {}).get('dataset', ''), 'meta.pkl')
+header['meta'] = None
+if os.path.exists(meta_path):
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+    if 'token_ids' in meta:
+        header['meta'] = {'token_ids': meta['token_ids']} # GPT-2 BPE with a compacted vocab
+    else:
+        header['meta'] = {'itos': [meta['itos'][i] for i in range(meta['vocab_size'])]}
+path = os.path.join(out_dir, 'ckpt.mmap')
+save_mmap_checkpoint(path, state_dict, header, dtype={'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype])
+print(f"wrote {path}: {os.path.getsize(path)/1e6:.2f}MB (ckpt.pt: {os.path.getsize(os.path.join(out_dir, 'ckpt.pt'))/1e6:.2f}MB)")
@@ -0,0 +1,43 @@
+"""
+Exports a checkpoint ahead of time with torch.export into out_dir/exported: a prefill and a
+single token decode program with dynamic batch and sequence dims (see exported.py). sample.py
+then runs them directly with --init_from=exported, without building the GPT in Python or
+waiting for torch.compile. With check=True the exported programs then have to reproduce the greedy
+tokens of GPT.generate, with and without its key/value cache, for a 1-token and a longer prompt.
+Example:
+$ python export_program.py --out_dir=out-shakespeare-char
+$ python sample.py --init_from=exported --out_dir=out-shakespeare-char
+"""
+import os
+import time
+import torch
+from inference import load_model
+from exported import export_gpt, ExportedGPT
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # read ckpt.pt from here if init_from is 'resume', the export is always written to out_dir/exported
+max_batch_size = 64 # largest batch the exported programs accept
+check = True # assert that the exported programs generate the same greedy tokens as the GPT
+check_tokens = 16 # tokens generated per check
+device = 'cpu' # the exported programs run on this device
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+model, checkpoint = load_model(init_from, out_dir, device)
+export_dir = os.path.join(out_dir, 'exported')
+t0 = time.time()
+export_gpt(model, checkpoint, export_dir, max_batch_size=max_batch_size)
+print(f"exported to {export_dir} in {time.time() - t0:.2f}s")
+
+if check:
+    exported = ExportedGPT(export_dir)
+    torch.manual_seed(1337)
+    for prompt_len in (1, 5): # a prompt of a single token is the prefill of T == 1
+        idx = torch.randint(model.config.vocab_size, (2, prompt_len), device=device)
+        # top_k=1 is greedy decoding, so both have to pick the same tokens
+        out = exported.generate(idx, check_tokens, top_k=1)
+        for use_kv_cache in (False, True):
+            ref = model.generate(idx, check_tokens, top_k=1, use_kv_cache=use_kv_cache)
+            assert torch.equal(out, ref), f"exported tokens differ from GPT.generate (prompt of {prompt_len}, use_kv_cache={use_kv_cache})"
+    print("check: the exported programs generate the same tokens as GPT.generate")
@@ -0,0 +1,27 @@
+"""
+Exports a weight-only quantized copy of a checkpoint for inference hosts: no optimizer state,
+every Linear weight as int8 or packed int4 with fp16 scales (see quant.py). The result is written
+next to the original as ckpt_int{bits}.pt and loads with sample.py --ckpt_name=ckpt_int{bits}.pt.
+Example:
+$ python export_quantized.py --out_dir=out-shakespeare-char --bits=4 --group_size=64
+$ python export_quantized.py --init_from=gpt2-xl --out_dir=out-gpt2-xl --bits=8
+"""
+import os
+import torch
+from inference import load_model
+from quant import quantized_checkpoint
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # read ckpt.pt from here if init_from is 'resume', the export is always written here
+bits = 8 # 8 or 4
+group_size = 0 # 0: one scale per output channel, else one scale per group_size input channels
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+model, checkpoint = load_model(init_from, out_dir, 'cpu')
+export = quantized_checkpoint(model, checkpoint, bits, group_size)
+os.makedirs(out_dir, exist_ok=True)
+path = os.path.join(out_dir, f'ckpt_int{bits}.pt')
+torch.save(export, path)
+print(f"wrote {path}: {os.path.getsize(path)/1e6:.2f}MB")
@@ -0,0 +1,119 @@
+"""
+Ahead-of-time exported GPT inference (written by export_program.py). A checkpoint is exported with
+torch.export into two programs with dynamic batch and sequence dims:
+- prefill: idx (B, T) -> logits of the last position (B, vocab_size) and the keys/values of all
+  layers (n_layer, B, n_kv_head, T, head_size)
+- decode: idx (B, 1) and the keys/values of the P positions before it -> logits (B, vocab_size)
+  and the keys/values of the P+1 positions
+ExportedGPT runs them without building the GPT in Python, so a sample.py cold start only has to
+load the programs. The programs run on the device they were exported on.
+"""
+import os
+import json
+import torch
+import torch.nn as nn
+
+from model import GPTConfig
+from sampling import sample, token_counts, uses_penalties
+
+class ConcatKVCache:
+    """
+    A stand-in for KVCache inside the exported programs: the new keys/values are concatenated to the
+    past ones instead of written into a preallocated buffer, which keeps the graphs functional.
+    """
+
+    def __init__(self, past_k=None, past_v=None):
+        self.past_k, self.past_v = past_k, past_v
+        self.k, self.v = [], []
+        self.length = 0
+
+    def update(self, layer, k, v, pos):
+        if self.past_k is not None:
+            k = torch.cat((self.past_k[layer], k), dim=2)
+            v = torch.cat((self.past_v[layer], v), dim=2)
+        self.k.append(k)
+        self.v.append(v)
+        return k, v
+
+class Prefill(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, idx):
+        cache = ConcatKVCache()
+        logits, _ = self.model(idx, kv_cache=cache)
+        return logits[:, -1, :], torch.stack(cache.k), torch.stack(cache.v)
+
+class DecodeStep(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, idx, past_k, past_v):
+        cache = ConcatKVCache(past_k.unbind(0), past_v.unbind(0))
+        logits, _ = self.model(idx, kv_cache=cache, pos_offset=past_k.size(3))
+        return logits[:, -1, :], torch.stack(cache.k), torch.stack(cache.v)
+
+def export_gpt(model, checkpoint, export_dir, max_batch_size=64):
+    """ exports the prefill and decode programs of a GPT in eval mode into export_dir """
+    cfg = model.config
+    batch = torch.export.Dim('batch', min=1, max=max_batch_size)
+    seq = torch.export.Dim('seq', min=1, max=cfg.block_size)
+    past = torch.export.Dim('past', min=1, max=cfg.block_size - 1)
+    # example inputs avoid sizes 0 and 1, which torch.export would specialize on. The attention doesn't
+    # branch on T for a prefill without a cache, so the program also takes 1-token prompts (seq min=1)
+    idx = torch.zeros(2, 3, dtype=torch.long, device=next(model.parameters()).device)
+    prefill = torch.export.export(Prefill(model), (idx,), dynamic_shapes={'idx': {0: batch, 1: seq}})
+    _, k, v = prefill.module()(idx)
+    decode = torch.export.export(DecodeStep(model), (idx[:, :1], k, v),
+                                 dynamic_shapes={'idx': {0: batch}, 'past_k': {1: batch, 3: past}, 'past_v': {1: batch, 3: past}})
+    os.makedirs(export_dir, exist_ok=True)
+    # what load_tokenizer and ExportedGPT need to know about the model, stored next to the programs
+    meta = {'model_args': checkpoint['model_args'], 'config': checkpoint.get('config', {})}
+    with open(os.path.join(export_dir, 'checkpoint.json'), 'w') as f:
+        json.dump(meta, f)
+    torch.export.save(prefill, os.path.join(export_dir, 'prefill.pt2'))
+    torch.export.save(decode, os.path.join(export_dir, 'decode.pt2'))
+
+class ExportedGPT:
+    """
+    Runs the programs exported by export_gpt with the generate()/generate_stream() interface of GPT
+    (minus the prefix cache), always decoding with a key/value cache.
+    """
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, 'checkpoint.json')) as f:
+            self.checkpoint = json.load(f)
+        self.config = GPTConfig(**self.checkpoint['model_args'])
+        self.prefill = torch.export.load(os.path.join(export_dir, 'prefill.pt2')).module()
+        self.decode = torch.export.load(os.path.join(export_dir, 'decode.pt2')).module()
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, generator=None, prefix_cache=None,
+                 top_p=None, repetition_penalty=None, frequency_penalty=None, window_stride=1):
+        steps = self.generate_stream(idx, max_new_tokens, temperature, top_k, use_kv_cache, generator, prefix_cache,
+                                     top_p, repetition_penalty, frequency_penalty, window_stride)
+        return torch.cat([idx] + list(steps), dim=1)
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, generator=None, prefix_cache=None,
+                        top_p=None, repetition_penalty=None, frequency_penalty=None, window_stride=1):
+        assert prefix_cache is None, "exported programs don't support a prefix cache"
+        block_size = self.config.block_size
+        counts = token_counts(idx, self.config.vocab_size) if uses_penalties(repetition_penalty, frequency_penalty) else None
+        k = v = None
+        for _ in range(max_new_tokens):
+            if k is None or k.size(3) >= block_size:
+                # (re)fill the keys/values from the window, sliding it by window_stride like GPT.step_logits
+                keep = block_size if k is None else max(1, block_size - window_stride + 1)
+                logits, k, v = self.prefill(idx[:, -keep:])
+            else:
+                logits, k, v = self.decode(idx[:, -1:], k, v)
+            idx_next = sample(logits, temperature, top_k, top_p, counts, repetition_penalty, frequency_penalty, generator)
+            if counts is not None:
+                counts.scatter_add_(1, idx_next, torch.ones_like(idx_next, dtype=counts.dtype))
+            idx = torch.cat((idx, idx_next), dim=1)
+            yield idx_next
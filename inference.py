@@ -0,0 +1,166 @@
+"""
+Helpers shared by the inference scripts (sample.py, server.py, bench_*.py) to load a
+model and the matching tokenizer, the same way sample.py has always done it.
+"""
+import os
+import codecs
+import pickle
+import torch
+import tiktoken
+from model import GPTConfig, GPT
+from quant import load_quantized
+from exported import ExportedGPT
+from mmap_ckpt import find_checkpoint, is_mmap_checkpoint, load_mmap_model
+
+def load_model(init_from, out_dir, device, ckpt_name=''):
+    """
+    Returns (model, checkpoint) with the model in eval mode on device. init_from is either
+    'resume' (from the ckpt_name file in out_dir) or a gpt2 variant (e.g. 'gpt2-xl'). checkpoint is
+    the checkpoint dict minus the weights and optimizer state, only holding the model_args for the gpt2 variants.
+    ckpt_name may also be a weight-only quantized checkpoint written by export_quantized.py or a
+    memory-mapped one written by export_mmap.py. By default it is the ckpt.mmap of out_dir if there
+    is one that is up to date with ckpt.pt, and ckpt.pt otherwise.
+    init_from='exported' loads the ExportedGPT in out_dir/exported instead (written by export_program.py),
+    which only supports generate() and generate_stream().
+    """
+    if init_from == 'resume':
+        # init from a model saved in a specific directory
+        ckpt_path = os.path.join(out_dir, ckpt_name or find_checkpoint(out_dir))
+        if is_mmap_checkpoint(ckpt_path):
+            print(f"Loading memory-mapped checkpoint {ckpt_path}")
+            return load_mmap_model(ckpt_path, device)
+        checkpoint = torch.load(ckpt_path, map_location=torch.device('cpu'))
+        if 'quantization' in checkpoint:
+            model = load_quantized(checkpoint, device)
+            checkpoint.pop('model')
+            return model, checkpoint
+        gptconf = GPTConfig(**checkpoint['model_args'])
+        model = GPT(gptconf)
+        state_dict = checkpoint.pop('model')
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
+        checkpoint.pop('optimizer', None)
+    elif init_from == 'exported':
+        # the torch.export programs written by export_program.py, the GPT is never built in Python
+        model = ExportedGPT(os.path.join(out_dir, 'exported'))
+        return model, model.checkpoint
+    elif init_from.startswith('gpt2'):
+        # init from a given GPT-2 model
+        model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+        # there is no training checkpoint, but record the config so exports of the model can be rebuilt
+        cfg = model.config
+        checkpoint = {'model_args': dict(n_layer=cfg.n_layer, n_head=cfg.n_head, n_embd=cfg.n_embd, block_size=cfg.block_size,
+                                         bias=cfg.bias, vocab_size=cfg.vocab_size, dropout=0.0)}
+    else:
+        raise ValueError(f"Unknown init_from: {init_from}")
+    model.eval()
+    model.to(device)
+    return model, checkpoint
+
+def quantize_model(model):
+    """
+    Converts the nn.Linear layers of a CPU model in place (c_attn, c_proj, c_fc and lm_head) to
+    int8 dynamically quantized linears: weights are stored as int8, activations are quantized on
+    the fly per batch. lm_head shares its weight with wte, so it gets its own int8 copy while the
+    embedding lookup keeps using the fp32 table. Inference only, the result can't be trained.
+    """
+    assert next(model.parameters()).device.type == 'cpu', "dynamic int8 quantization is only supported on CPU"
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def init_scratch_model(dataset, device, **model_args):
+    """
+    Returns a randomly initialized GPT in eval mode, for benchmarking without a trained checkpoint.
+    model_args are GPTConfig fields, the vocab size comes from data/<dataset>/meta.pkl if it exists.
+    """
+    meta_path = os.path.join('data', dataset, 'meta.pkl')
+    vocab_size = 50304
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            vocab_size = pickle.load(f)['vocab_size']
+    model = GPT(GPTConfig(vocab_size=vocab_size, dropout=0.0, **model_args))
+    model.eval()
+    model.to(device)
+    return model
+
+def load_tokenizer(checkpoint):
+    """
+    Returns (encode, decode) for the dataset the checkpoint was trained on: its meta.pkl
+    if there is one in the dataset folder, GPT-2 BPE otherwise. A meta.pkl with token_ids is
+    GPT-2 BPE with a compacted vocab, ids are mapped through it.
+    """
+    meta = _load_meta(checkpoint)
+    if meta is not None and 'token_ids' in meta:
+        enc = tiktoken.get_encoding("gpt2")
+        token_ids = meta['token_ids']
+        compact = {t: i for i, t in enumerate(token_ids)}
+        def encode(s):
+            ids = enc.encode(s, allowed_special={"<|endoftext|>"})
+            missing = [t for t in ids if t not in compact]
+            if missing:
+                raise ValueError(f"tokens not in the compacted vocab of the dataset: {[enc.decode([t]) for t in missing]}")
+            return [compact[t] for t in ids]
+        decode = lambda l: enc.decode([token_ids[i] for i in l])
+    elif meta is not None:
+        # TODO want to make this more general to arbitrary encoder/decoder schemes
+        stoi, itos = meta['stoi'], meta['itos']
+        encode = lambda s: [stoi[c] for c in s]
+        decode = lambda l: ''.join([itos[i] for i in l])
+    else:
+        # ok let's assume gpt-2 encodings by default
+        enc = tiktoken.get_encoding("gpt2")
+        encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
+        decode = lambda l: enc.decode(l)
+    return encode, decode
+
+def load_token_bytes(checkpoint):
+    """
+    Returns token_bytes(token) -> bytes, the UTF-8 bytes of a single token, for a StreamDecoder.
+    A GPT-2 BPE token can hold only part of a multi-byte character, so unlike decode() this
+    doesn't turn the token into text on its own.
+    """
+    meta = _load_meta(checkpoint)
+    if meta is not None and 'token_ids' in meta:
+        enc, token_ids = tiktoken.get_encoding("gpt2"), meta['token_ids']
+        return lambda token: enc.decode_single_token_bytes(token_ids[token])
+    if meta is not None:
+        itos = meta['itos']
+        return lambda token: itos[token].encode('utf-8')
+    enc = tiktoken.get_encoding("gpt2")
+    return enc.decode_single_token_bytes
+
+class StreamDecoder:
+    """
+    Incremental detokenizer for streaming: push() takes one token at a time and returns the text
+    that is complete so far, holding back the bytes of a UTF-8 character split across tokens.
+    """
+
+    def __init__(self, token_bytes):
+        self.token_bytes = token_bytes
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def push(self, token):
+        return self.utf8.decode(self.token_bytes(token))
+
+    def flush(self):
+        # whatever is still held back at the end of the stream, as replacement characters
+        return self.utf8.decode(b'', final=True)
+
+def _load_meta(checkpoint):
+    # the meta.pkl of the checkpoint's dataset folder if it is available, None otherwise
+    if checkpoint is not None and checkpoint.get('meta') is not None:
+        # stored in the header of memory-mapped checkpoints, itos as a list
+        if 'token_ids' in checkpoint['meta']:
+            return {'vocab_size': len(checkpoint['meta']['token_ids']), 'token_ids': checkpoint['meta']['token_ids']}
+        itos = dict(enumerate(checkpoint['meta']['itos']))
+        return {'vocab_size': len(itos), 'itos': itos, 'stoi': {c: i for i, c in itos.items()}}
+    if checkpoint is not None and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+        meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
+        if os.path.exists(meta_path):
+            print(f"Loading meta from {meta_path}...")
+            with open(meta_path, 'rb') as f:
+                return pickle.load(f)
+    print("No meta.pkl found, assuming GPT-2 encodings...")
+    return None
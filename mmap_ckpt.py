@@ -0,0 +1,100 @@
+"""
+Inference-only checkpoint format (written by export_mmap.py): a JSON header followed by the raw
+weights, every tensor 64-byte aligned. The file is memory-mapped and the parameters of the GPT
+are views into the mapping, so loading reads neither the optimizer state of ckpt.pt nor copies
+the weights, pages are only read in as the forward touches them. Layout:
+    b'NGPTMMAP' | header length (uint64, little endian) | JSON header | padding | tensor data
+The header holds model_args, config, iter_num, best_val_loss, the dataset meta (itos, or the token_ids of a compacted vocab) if there is
+one, and name -> {dtype, shape, offset} of every tensor, offsets relative to the data start.
+"""
+import os
+import json
+import math
+import mmap
+import struct
+import torch
+
+from model import GPTConfig, GPT
+
+MAGIC = b'NGPTMMAP'
+ALIGN = 64
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def save_mmap_checkpoint(path, state_dict, header, dtype=None):
+    """
+    Writes state_dict (and header, a JSON serializable dict) to path. Floating point tensors are
+    cast to dtype if given, tensors sharing their storage (like tied weights) are written once.
+    """
+    tensors, blobs, offset, seen = {}, [], 0, {}
+    for name, t in state_dict.items():
+        key = (t.data_ptr(), t.dtype, tuple(t.shape))
+        if key not in seen:
+            t = t.detach().cpu()
+            if dtype is not None and t.is_floating_point():
+                t = t.to(dtype)
+            seen[key] = dict(dtype=str(t.dtype).replace('torch.', ''), shape=list(t.shape), offset=offset)
+            data = t.contiguous().view(torch.uint8).numpy().tobytes() if t.numel() else b''
+            blobs.append((offset, data))
+            offset = _align(offset + len(data))
+        tensors[name] = seen[key]
+    header = json.dumps(dict(header, tensors=tensors)).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        data_start = _align(f.tell())
+        for off, data in blobs:
+            f.seek(data_start + off)
+            f.write(data)
+
+def load_mmap_checkpoint(path):
+    """ returns (state_dict, header), the tensors of state_dict are views of the mapped file """
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, f"{path} is not a memory-mapped checkpoint"
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n))
+        # copy-on-write, torch.frombuffer wants a writable buffer but nothing ever writes to it
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = _align(len(MAGIC) + 8 + n)
+    state_dict = {}
+    for name, t in header.pop('tensors').items():
+        dtype, numel = getattr(torch, t['dtype']), math.prod(t['shape'])
+        if numel == 0:
+            state_dict[name] = torch.empty(t['shape'], dtype=dtype)
+            continue
+        state_dict[name] = torch.frombuffer(buf, dtype=dtype, count=numel, offset=data_start + t['offset']).view(t['shape'])
+    return state_dict, header
+
+def is_mmap_checkpoint(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def find_checkpoint(out_dir):
+    # the checkpoint file to load from out_dir: ckpt.mmap unless ckpt.pt was saved after it was exported
+    mmap_path, ckpt_path = os.path.join(out_dir, 'ckpt.mmap'), os.path.join(out_dir, 'ckpt.pt')
+    if os.path.exists(mmap_path) and (not os.path.exists(ckpt_path) or os.path.getmtime(mmap_path) >= os.path.getmtime(ckpt_path)):
+        return 'ckpt.mmap'
+    return 'ckpt.pt'
+
+def load_mmap_model(path, device):
+    """
+    Returns (model, checkpoint): a GPT in eval mode whose parameters are the mapped tensors (on CPU,
+    copied to other devices), and the header as the checkpoint dict, like inference.load_model.
+    """
+    state_dict, checkpoint = load_mmap_checkpoint(path)
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    assert not unexpected and all(k.endswith('.attn.bias') for k in missing), f"bad mmap checkpoint: {missing}, {unexpected}"
+    # the two names of the tied weight were loaded as separate views of the same bytes, tie them again
+    model.transformer.wte.weight = model.lm_head.weight
+    for block in model.transformer.h:
+        if hasattr(block.attn, 'bias'):
+            # the causal mask of the slow attention path isn't stored, rebuild it
+            T = model.config.block_size
+            block.attn.bias = torch.tril(torch.ones(T, T)).view(1, 1, T, T)
+    model.eval()
+    model.to(device)
+    return model, checkpoint
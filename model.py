@@ -13,8 +13,12 @@ from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
 
+from sampling import sample, sampling_probs, token_counts, uses_penalties
+from perf import peak_flops, throughput
+
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
 
@@ -26,50 +30,220 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+def _tile_mask(pos, i0, i1, j0, j1, device):
+    # which keys [j0, j1) the queries [i0, i1) may attend to, query i sits at position pos+i,
+    # or at pos[b] for a (B,) tensor of per-row positions (then there is a single query)
+    k_pos = torch.arange(j0, j1, device=device)
+    if torch.is_tensor(pos):
+        return k_pos <= pos.view(-1, 1, 1, 1) # (B, 1, 1, tk)
+    return k_pos <= torch.arange(pos + i0, pos + i1, device=device).view(-1, 1) # (tq, tk)
+
+def _key_end(pos, i1, Tk):
+    # the keys past the last query of the tile [.., i1) are all masked, their tiles are skipped
+    return Tk if torch.is_tensor(pos) else min(Tk, pos + i1)
+
+class BlockwiseAttention(torch.autograd.Function):
+    """
+    Causal attention over tiles of `tile` queries and keys with an online softmax: the running max
+    and sum of each query row are updated tile by tile, so memory is O(T * tile) instead of the
+    (T, Tk) matrix of the math path. The backward recomputes the probabilities of every tile from
+    the saved log-sum-exp of the rows. q is (B, nh, T, hs), k and v (B, nh, Tk, hs), pos as in _tile_mask.
+    With dropout > 0 the probabilities are dropped out tile by tile, and the backward regenerates the
+    mask of each tile from a seed drawn in the forward instead of saving it.
+    """
+
+    @staticmethod
+    def _keep(seed, i0, j0, Tk, shape, dropout, device):
+        # the dropout mask of tile (i0, j0), scaled by 1 / (1 - dropout) like F.dropout
+        g = torch.Generator(device=device).manual_seed(seed + i0 * Tk + j0)
+        return (torch.rand(shape, generator=g, device=device) >= dropout).float() / (1 - dropout)
+
+    @staticmethod
+    def forward(ctx, q, k, v, pos, tile, dropout=0.0):
+        scale = 1.0 / math.sqrt(q.size(-1))
+        # from the global RNG, so activation checkpointing (preserve_rng_state) replays the same masks
+        seed = int(torch.randint(2**62, (1,))) if dropout > 0 else 0
+        T, Tk = q.size(2), k.size(2)
+        y = torch.empty_like(q)
+        lse = q.new_empty(q.shape[:-1], dtype=torch.float32) # (B, nh, T)
+        for i0 in range(0, T, tile):
+            i1 = min(i0 + tile, T)
+            qi = q[:, :, i0:i1]
+            m = torch.full(qi.shape[:-1], float('-inf'), device=q.device)
+            l = torch.zeros(qi.shape[:-1], device=q.device)
+            acc = torch.zeros(qi.shape, device=q.device)
+            for j0 in range(0, _key_end(pos, i1, Tk), tile):
+                j1 = min(j0 + tile, Tk)
+                s = (qi @ k[:, :, j0:j1].transpose(-2, -1)).float() * scale
+                s = s.masked_fill(~_tile_mask(pos, i0, i1, j0, j1, q.device), float('-inf'))
+                # key 0 is visible to every query, so m is finite from the first tile on
+                m_new = torch.maximum(m, s.amax(dim=-1))
+                p = torch.exp(s - m_new.unsqueeze(-1))
+                correction = torch.exp(m - m_new)
+                l = l * correction + p.sum(dim=-1)
+                if dropout > 0:
+                    # dropping the unnormalized p is the same as dropping the probabilities, l stays undropped
+                    p = p * BlockwiseAttention._keep(seed, i0, j0, Tk, p.shape, dropout, q.device)
+                acc = acc * correction.unsqueeze(-1) + (p.to(v.dtype) @ v[:, :, j0:j1]).float()
+                m = m_new
+            y[:, :, i0:i1] = (acc / l.unsqueeze(-1)).to(q.dtype)
+            lse[:, :, i0:i1] = m + torch.log(l)
+        ctx.save_for_backward(q, k, v, y, lse)
+        ctx.pos, ctx.tile, ctx.dropout, ctx.seed = pos, tile, dropout, seed
+        return y
+
+    @staticmethod
+    def backward(ctx, dy):
+        q, k, v, y, lse = ctx.saved_tensors
+        pos, tile, dropout, seed = ctx.pos, ctx.tile, ctx.dropout, ctx.seed
+        scale = 1.0 / math.sqrt(q.size(-1))
+        T, Tk = q.size(2), k.size(2)
+        dy = dy.float()
+        D = (dy * y.float()).sum(dim=-1) # (B, nh, T), rowsum of dP * P, also with dropout since y is the dropped out P @ v
+        dq = torch.zeros(q.shape, device=q.device)
+        dk = torch.zeros(k.shape, device=k.device)
+        dv = torch.zeros(v.shape, device=v.device)
+        for i0 in range(0, T, tile):
+            i1 = min(i0 + tile, T)
+            qi, dyi = q[:, :, i0:i1].float(), dy[:, :, i0:i1]
+            for j0 in range(0, _key_end(pos, i1, Tk), tile):
+                j1 = min(j0 + tile, Tk)
+                kj, vj = k[:, :, j0:j1].float(), v[:, :, j0:j1].float()
+                s = (qi @ kj.transpose(-2, -1)) * scale
+                s = s.masked_fill(~_tile_mask(pos, i0, i1, j0, j1, q.device), float('-inf'))
+                p = torch.exp(s - lse[:, :, i0:i1].unsqueeze(-1))
+                dp = dyi @ vj.transpose(-2, -1)
+                if dropout > 0:
+                    keep = BlockwiseAttention._keep(seed, i0, j0, Tk, p.shape, dropout, q.device)
+                    dv[:, :, j0:j1] += (p * keep).transpose(-2, -1) @ dyi
+                    dp = dp * keep
+                else:
+                    dv[:, :, j0:j1] += p.transpose(-2, -1) @ dyi
+                ds = p * (dp - D[:, :, i0:i1].unsqueeze(-1))
+                dq[:, :, i0:i1] += (ds @ kj) * scale
+                dk[:, :, j0:j1] += (ds.transpose(-2, -1) @ qi) * scale
+        return dq.to(q.dtype), dk.to(k.dtype), dv.to(v.dtype), None, None, None
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    F.cross_entropy(x @ weight.T, targets, ignore_index=-1) over chunks of `chunk` rows of x, so only
+    a (chunk, vocab_size) block of logits exists at a time. The loss is a scalar, so the gradients
+    of x and weight are computed chunk by chunk in the forward already, and backward only scales them.
+    x is (N, C), weight (V, C) (the lm_head weight, tied to wte), targets (N,).
+    Without grad mode (e.g. estimate_loss) call ChunkedCrossEntropy.loss instead, which skips the gradients.
+    """
+
+    @staticmethod
+    def loss(x, weight, targets, chunk, needs_grad=False):
+        """ returns (loss, dx, dw), with the gradients of the mean loss only if needs_grad (None otherwise) """
+        valid = targets != -1
+        n_valid = valid.sum()
+        loss = torch.zeros((), device=x.device)
+        dx = torch.zeros(x.shape, device=x.device) if needs_grad else None
+        dw = torch.zeros(weight.shape, device=weight.device) if needs_grad else None
+        for i in range(0, x.size(0), chunk):
+            xi, ti, vi = x[i:i+chunk], targets[i:i+chunk], valid[i:i+chunk]
+            logits = (xi @ weight.t()).float()
+            lse = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(1, ti.clamp(min=0).unsqueeze(1)).squeeze(1)
+            loss += ((lse - target_logits) * vi).sum()
+            if needs_grad:
+                # d(sum of losses)/dlogits = softmax - onehot(target), zero for the ignored rows
+                dlogits = torch.exp(logits - lse.unsqueeze(1))
+                dlogits.scatter_add_(1, ti.clamp(min=0).unsqueeze(1), -torch.ones_like(dlogits[:, :1]))
+                dlogits *= vi.unsqueeze(1)
+                dx[i:i+chunk] = dlogits.to(weight.dtype) @ weight
+                dw += (dlogits.t().to(xi.dtype) @ xi).float()
+            del logits
+        # mean over the targets that aren't ignored, nan if there are none, like F.cross_entropy
+        if not needs_grad:
+            return loss / n_valid, None, None
+        return loss / n_valid, (dx / n_valid).to(x.dtype), (dw / n_valid).to(weight.dtype)
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk):
+        loss, dx, dw = ChunkedCrossEntropy.loss(x, weight, targets, chunk, needs_grad=True)
+        ctx.save_for_backward(dx, dw)
+        return loss
+
+    @staticmethod
+    def backward(ctx, dloss):
+        dx, dw = ctx.saved_tensors
+        return dx * dloss.to(dx.dtype), dw * dloss.to(dw.dtype), None, None
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
         super().__init__()
-        assert config.n_embd % config.n_head == 0
+        assert config.head_size or config.n_embd % config.n_head == 0
+        # n_head * head_size is n_embd unless the heads were pruned (see pruning.py)
+        self.head_size = config.head_size or config.n_embd // config.n_head
+        self.q_dim = config.n_head * self.head_size
+        # groups of n_head // n_kv_head query heads share a key/value head, n_kv_head == n_head is plain multi-head
+        self.n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_head % self.n_kv_head == 0
+        self.kv_dim = self.n_kv_head * self.head_size
         # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=config.bias)
+        self.c_attn = nn.Linear(config.n_embd, self.q_dim + 2 * self.kv_dim, bias=config.bias)
         # output projection
-        self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=config.bias)
+        self.c_proj = nn.Linear(self.q_dim, config.n_embd, bias=config.bias)
         # regularization
         self.attn_dropout = nn.Dropout(config.dropout)
         self.resid_dropout = nn.Dropout(config.dropout)
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.dropout = config.dropout
+        # blockwise attention over tiles of this many positions, never materializes the (T, T) matrix
+        self.attn_block_size = config.attn_block_size
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
-        self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
-        if not self.flash:
+        self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention') and not self.attn_block_size
+        if not self.flash and not self.attn_block_size:
             print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
             # causal mask to ensure that attention is only applied to the left in the input sequence
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, layer=0, pos_offset=0):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k, v  = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        q, k, v  = self.c_attn(x).split([self.q_dim, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, self.head_size).transpose(1, 2) # (B, nkvh, T, hs)
+        q = q.view(B, T, self.n_head, self.head_size).transpose(1, 2) # (B, nh, T, hs)
+        v = v.view(B, T, self.n_kv_head, self.head_size).transpose(1, 2) # (B, nkvh, T, hs)
+        if kv_cache is not None:
+            # write the new keys/values at [pos_offset, pos_offset+T) and attend over everything up to there
+            k, v = kv_cache.update(layer, k, v, pos_offset)
+        if self.n_kv_head != self.n_head:
+            # the cache only holds the n_kv_head heads, every query head gets the key/value head of its group
+            k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1) # (B, nh, Tk, hs)
+            v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+        Tk = k.size(2) # number of key positions, Tk > T when decoding against a cache
+        if torch.is_tensor(pos_offset):
+            # one new token per row, each at its own position: a row only sees the keys up to its position
+            attn_mask = (torch.arange(Tk, device=x.device) <= pos_offset.view(-1, 1)).view(B, 1, 1, Tk)
+        elif self.flash and Tk > T and T > 1:
+            # is_causal aligns the mask to the top-left, so with a cache we build the offset mask ourselves.
+            # Tk > T comes first: without a cache Tk is T, so torch.export decides this without guarding on T
+            attn_mask = torch.ones(T, Tk, dtype=torch.bool, device=x.device).tril(diagonal=Tk - T)
+        else:
+            attn_mask = None
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, Tk) -> (B, nh, T, Tk)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=attn_mask is None and Tk == T)
+        elif self.attn_block_size:
+            y = BlockwiseAttention.apply(q, k, v, pos_offset if torch.is_tensor(pos_offset) else Tk - T, self.attn_block_size,
+                                         self.dropout if self.training else 0.0)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            att = att.masked_fill(~attn_mask if attn_mask is not None else self.bias[:,:,Tk-T:Tk,:Tk] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+            y = att @ v # (B, nh, T, Tk) x (B, nh, Tk, hs) -> (B, nh, T, hs)
+        y = y.transpose(1, 2).contiguous().view(B, T, self.q_dim) # re-assemble all head outputs side by side
 
         # output projection
         y = self.resid_dropout(self.c_proj(y))
@@ -79,9 +253,10 @@ class MLP(nn.Module):
 
     def __init__(self, config):
         super().__init__()
-        self.c_fc    = nn.Linear(config.n_embd, 4 * config.n_embd, bias=config.bias)
+        hidden = config.mlp_hidden or 4 * config.n_embd
+        self.c_fc    = nn.Linear(config.n_embd, hidden, bias=config.bias)
         self.gelu    = nn.GELU()
-        self.c_proj  = nn.Linear(4 * config.n_embd, config.n_embd, bias=config.bias)
+        self.c_proj  = nn.Linear(hidden, config.n_embd, bias=config.bias)
         self.dropout = nn.Dropout(config.dropout)
 
     def forward(self, x):
@@ -100,20 +275,94 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None, layer=0, pos_offset=0):
+        x = x + self.attn(self.ln_1(x), kv_cache, layer, pos_offset)
         x = x + self.mlp(self.ln_2(x))
         return x
 
+class KVCache:
+    """
+    Per-layer key/value buffers for incremental decoding. A GPT forward with a cache only has to
+    process the new tokens, the keys/values of everything before them are read back from here.
+    The buffers are allocated lazily on the first write so they follow the device/dtype of the keys,
+    and grow when a batch with more rows comes along.
+    """
+
+    def __init__(self, n_layer, max_len):
+        self.max_len = max_len # typically config.block_size
+        self.k = [None] * n_layer
+        self.v = [None] * n_layer
+        self.length = 0 # number of positions currently held, i.e. the pos_offset of the next token
+
+    def update(self, layer, k, v, pos):
+        # k, v are (B, nkvh, T, hs) (nkvh: config.n_kv_head); store them at positions [pos, pos+T) and return the first pos+T.
+        # pos can also be a (B,) LongTensor with one position per row, for single token steps (T == 1)
+        B, nh, T, hs = k.size()
+        k_buf, v_buf = self._buffers(layer, B, k)
+        if torch.is_tensor(pos):
+            assert T == 1, "per-row positions are only supported for single token steps"
+            rows = torch.arange(B, device=k.device)
+            k_buf[rows, :, pos] = k[:, :, 0]
+            v_buf[rows, :, pos] = v[:, :, 0]
+            end = int(pos.max()) + 1
+        else:
+            assert pos + T <= self.max_len, f"KVCache overflow: {pos + T} > {self.max_len}"
+            k_buf[:, :, pos:pos+T] = k
+            v_buf[:, :, pos:pos+T] = v
+            end = pos + T
+        return k_buf[:, :, :end], v_buf[:, :, :end]
+
+    def insert(self, row, other, length):
+        # copy the first length positions of row 0 of another cache into the given row of this one
+        for layer in range(len(self.k)):
+            k_buf, v_buf = self._buffers(layer, row + 1, other.k[layer])
+            k_buf[row, :, :length] = other.k[layer][0, :, :length]
+            v_buf[row, :, :length] = other.v[layer][0, :, :length]
+
+    def move(self, src, dst, length):
+        # copy the first length positions of row src over row dst, e.g. to keep the live rows contiguous
+        for layer in range(len(self.k)):
+            self.k[layer][dst, :, :length] = self.k[layer][src, :, :length]
+            self.v[layer][dst, :, :length] = self.v[layer][src, :, :length]
+
+    def select(self, rows):
+        # keep only the given rows (LongTensor, may repeat a row), in that order, e.g. to follow beam search
+        for layer in range(len(self.k)):
+            if self.k[layer] is not None:
+                self.k[layer] = self.k[layer].index_select(0, rows)
+                self.v[layer] = self.v[layer].index_select(0, rows)
+
+    def reset(self):
+        self.length = 0
+
+    def _buffers(self, layer, B, like):
+        # (re)allocate the buffers of a layer so that they hold at least B rows, keeping their content
+        if self.k[layer] is None or self.k[layer].size(0) < B:
+            _, nh, _, hs = like.size()
+            n_old = 0 if self.k[layer] is None else self.k[layer].size(0)
+            k_buf = like.new_zeros(max(B, 2 * n_old), nh, self.max_len, hs)
+            v_buf = like.new_zeros(max(B, 2 * n_old), nh, self.max_len, hs)
+            if n_old:
+                k_buf[:n_old] = self.k[layer]
+                v_buf[:n_old] = self.v[layer]
+            self.k[layer], self.v[layer] = k_buf, v_buf
+        return self.k[layer][:B], self.v[layer][:B]
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
     vocab_size: int = 50304 # GPT-2 vocab_size of 50257, padded up to nearest multiple of 64 for efficiency
     n_layer: int = 12
     n_head: int = 12
+    n_kv_head: int = 0 # key/value heads, each shared by n_head // n_kv_head query heads (1: multi-query), 0: n_head
+    head_size: int = 0 # 0: n_embd // n_head, only differs in models with pruned heads
+    mlp_hidden: int = 0 # 0: 4 * n_embd, only differs in models with pruned MLP channels
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+    attn_block_size: int = 0 # > 0: blockwise attention over tiles of this many positions instead of flash/math attention
+    activation_checkpointing: int = 0 # recompute the activations of every k-th Block in backward instead of keeping them, 0: none, 1: all
+    loss_chunk_size: int = 0 # > 0: compute the loss over chunks of this many positions, never building the full (b*t, vocab_size) logits
 
 class GPT(nn.Module):
 
@@ -167,24 +416,59 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, pos_offset=0, all_logits=False, return_hidden=False):
+        """
+        With a kv_cache, idx holds only the tokens at positions [pos_offset, pos_offset+t) and the
+        keys/values of the earlier positions are taken from (and the new ones written to) the cache.
+        pos_offset may also be a (b,) LongTensor so that every row of a single token step (t == 1)
+        continues at its own position, as used by continuous batching.
+        Without targets only the logits of the last position are returned, unless all_logits=True.
+        With targets and config.loss_chunk_size the loss is computed chunk by chunk and logits is None.
+        return_hidden=True returns the final hidden states (b, t, n_embd) in place of the logits, without a loss.
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        if torch.is_tensor(pos_offset):
+            # every row continues at its own position, shape (b, t)
+            pos = pos_offset.view(-1, 1) + torch.arange(0, t, dtype=torch.long, device=device)
+        else:
+            assert pos_offset + t <= self.config.block_size, f"Cannot forward sequence of length {pos_offset + t}, block size is only {self.config.block_size}"
+            pos = torch.arange(pos_offset, pos_offset + t, dtype=torch.long, device=device) # shape (t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        every = self.config.activation_checkpointing
+        for i, block in enumerate(self.transformer.h):
+            if every and i % every == 0 and self.training and kv_cache is None and torch.is_grad_enabled():
+                # only the block input is kept, its activations are recomputed in backward with the same dropout
+                # masks (the RNG state is restored). Non-reentrant, which works with torch.compile and DDP
+                x = torch.utils.checkpoint.checkpoint(block, x, use_reentrant=False, preserve_rng_state=True)
+            else:
+                x = block(x, kv_cache, i, pos_offset)
         x = self.transformer.ln_f(x)
-
-        if targets is not None:
+        if kv_cache is not None:
+            kv_cache.length = pos_offset + t
+
+        if return_hidden:
+            # for losses that apply the lm_head themselves, e.g. chunk by chunk in distill.py
+            return x, None
+        if targets is not None and self.config.loss_chunk_size and isinstance(self.lm_head, nn.Linear):
+            # fused lm_head + cross-entropy over chunks of positions, the full logits are never returned
+            args = (x.view(-1, x.size(-1)), self.lm_head.weight, targets.reshape(-1), self.config.loss_chunk_size)
+            if torch.is_grad_enabled():
+                loss = ChunkedCrossEntropy.apply(*args)
+            else:
+                loss, _, _ = ChunkedCrossEntropy.loss(*args) # no dx and (vocab_size, n_embd) dw under no_grad
+            logits = None
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
+        elif all_logits:
+            logits = self.lm_head(x)
+            loss = None
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
@@ -204,11 +488,12 @@ class GPT(nn.Module):
                 block.attn.bias = block.attn.bias[:,:,:block_size,:block_size]
 
     @classmethod
-    def from_pretrained(cls, model_type, override_args=None):
+    def from_pretrained(cls, model_type, override_args=None, token_ids=None):
+        # token_ids: keep only the rows of wte/lm_head of these GPT-2 ids, in this order, for datasets with a compacted vocab
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
         override_args = override_args or {} # default to empty dict
-        # only dropout can be overridden see more notes below
-        assert all(k == 'dropout' for k in override_args)
+        # only dropout and how the forward is computed can be overridden see more notes below
+        assert all(k in ('dropout', 'attn_block_size', 'activation_checkpointing', 'loss_chunk_size') for k in override_args)
         from transformers import GPT2LMHeadModel
         print("loading weights from pretrained gpt: %s" % model_type)
 
@@ -221,12 +506,18 @@ class GPT(nn.Module):
         }[model_type]
         print("forcing vocab_size=50257, block_size=1024, bias=True")
         config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
+        if token_ids is not None:
+            print(f"keeping the {len(token_ids)} token ids of the compacted vocab")
+            config_args['vocab_size'] = len(token_ids)
         config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
         config_args['bias'] = True # always True for GPT model checkpoints
         # we can override the dropout rate, if desired
         if 'dropout' in override_args:
             print(f"overriding dropout rate to {override_args['dropout']}")
             config_args['dropout'] = override_args['dropout']
+        for k in ('attn_block_size', 'activation_checkpointing', 'loss_chunk_size'):
+            if k in override_args:
+                config_args[k] = override_args[k]
         # create a from-scratch initialized minGPT model
         config = GPTConfig(**config_args)
         model = GPT(config)
@@ -237,6 +528,11 @@ class GPT(nn.Module):
         # init a huggingface/transformers model
         model_hf = GPT2LMHeadModel.from_pretrained(model_type)
         sd_hf = model_hf.state_dict()
+        if token_ids is not None:
+            # the compacted vocab: row i of the embedding and the lm_head is GPT-2 token token_ids[i]
+            rows = torch.tensor(token_ids, dtype=torch.long)
+            for k in ('transformer.wte.weight', 'lm_head.weight'):
+                sd_hf[k] = sd_hf[k][rows]
 
         # copy while ensuring all of the parameters are aligned and match in names and shapes
         sd_keys_hf = sd_hf.keys()
@@ -286,45 +582,244 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_mfu(self, fwdbwd_per_iter, dt):
-        """ estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS """
-        # first estimate the number of flops we do per iteration.
-        # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
-        N = self.get_num_params()
-        cfg = self.config
-        L, H, Q, T = cfg.n_layer, cfg.n_head, cfg.n_embd//cfg.n_head, cfg.block_size
-        flops_per_token = 6*N + 12*L*H*Q*T
-        flops_per_fwdbwd = flops_per_token * T
-        flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-        # express our flops throughput as ratio of A100 bfloat16 peak flops
-        flops_achieved = flops_per_iter * (1.0/dt) # per second
-        flops_promised = 312e12 # A100 GPU bfloat16 peak flops is 312 TFLOPS
-        mfu = flops_achieved / flops_promised
-        return mfu
+    def estimate_mfu(self, fwdbwd_per_iter, dt, T=None, peak=None, dtype=None):
+        """
+        estimate model flops utilization (MFU) of fwdbwd_per_iter forward+backward passes of sequences of
+        length T (block_size by default) in dt seconds, relative to peak FLOPS. By default peak is
+        perf.peak_flops of the model's device in dtype (the parameter dtype unless given, pass the autocast
+        one), calibrated once per host. The FLOPs are counted per matmul by perf.step_flops.
+        """
+        if peak is None:
+            weight = self.lm_head.weight
+            peak = peak_flops(weight.device, dtype or weight.dtype)
+        return throughput(self.config, fwdbwd_per_iter, T or self.config.block_size, dt, peak)['mfu']
+
+    def step_logits(self, idx, kv_cache, window_stride=1):
+        """
+        The logits (b, vocab_size) of the token following idx (LongTensor of shape (b,t)), for decoding
+        one token at a time: kv_cache holds the keys/values of idx minus its last token from the previous
+        call (or nothing), and only what it doesn't hold yet is forwarded.
+        Once the sequence outgrows block_size the model sees a window of it that slides by window_stride
+        tokens at a time: when the cache is full it is refilled from the last block_size - window_stride + 1
+        tokens at positions starting from 0 again, then only appended to until it is full again. So a full
+        forward of the window happens every window_stride tokens instead of every token, at the cost of a
+        shorter context right after each slide. window_stride=1 is the same as cropping to the last
+        block_size tokens every step.
+        """
+        block_size = self.config.block_size
+        if kv_cache.length == 0 or kv_cache.length >= block_size:
+            keep = block_size if kv_cache.length == 0 else max(1, block_size - window_stride + 1)
+            logits, _ = self(idx[:, -keep:], kv_cache=kv_cache, pos_offset=0)
+        else:
+            logits, _ = self(idx[:, -1:], kv_cache=kv_cache, pos_offset=kv_cache.length)
+        return logits[:, -1, :]
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=False, generator=None, prefix_cache=None,
+                 top_p=None, repetition_penalty=None, frequency_penalty=None, window_stride=1):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_kv_cache=True the keys/values of past tokens are cached, so every step after the
+        first only forwards the newest token instead of the whole context.
+        generator is an optional torch.Generator, or a list of them with one per row of idx so that
+        every row is sampled from its own RNG stream and doesn't depend on what else is in the batch.
+        prefix_cache is an optional PrefixCache (see prefix_cache.py), used with use_kv_cache=True when
+        all rows of idx hold the same prompt: a cached prefix of it is not forwarded again, and the
+        prompt is added to the cache for later calls.
+        temperature, top_k, top_p, repetition_penalty and frequency_penalty are scalars or have one
+        value per row of idx, see sampling.py.
+        window_stride only matters with use_kv_cache=True once the sequence is longer than block_size,
+        see step_logits().
+        """
+        steps = self.generate_stream(idx, max_new_tokens, temperature, top_k, use_kv_cache, generator, prefix_cache,
+                                     top_p, repetition_penalty, frequency_penalty, window_stride)
+        return torch.cat([idx] + list(steps), dim=1)
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=False, generator=None, prefix_cache=None,
+                        top_p=None, repetition_penalty=None, frequency_penalty=None, window_stride=1):
         """
+        Same as generate(), but a generator that yields the sampled tokens (LongTensor of shape (b,1))
+        one step at a time, as soon as they are sampled, instead of the completed sequence at the end.
+        """
+        counts = None
+        if uses_penalties(repetition_penalty, frequency_penalty):
+            counts = token_counts(idx, self.config.vocab_size)
+        kv_cache = KVCache(self.config.n_layer, self.config.block_size) if use_kv_cache else None
+        if kv_cache is not None and prefix_cache is not None and idx.size(1) <= self.config.block_size and (idx == idx[:1]).all():
+            prompt = idx[0].tolist()
+            cached, n = prefix_cache.lookup(self, prompt)
+            if cached is not None:
+                for row in range(idx.size(0)):
+                    kv_cache.insert(row, cached, n)
+                kv_cache.length = n
+        else:
+            prompt = None
         for _ in range(max_new_tokens):
             # if the sequence context is growing too long we must crop it at block_size
             idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
             # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+            if kv_cache is None:
+                logits = self(idx_cond)[0][:, -1, :]
+            elif prompt is not None:
+                # first step with a prefix cache: only forward the prompt after the cached prefix
+                logits = self(idx[:, kv_cache.length:], kv_cache=kv_cache, pos_offset=kv_cache.length)[0][:, -1, :]
+                prefix_cache.put(self, prompt, kv_cache)
+                prompt = None
+            else:
+                logits = self.step_logits(idx, kv_cache, window_stride)
+            # sample from the logits at the final step
+            idx_next = sample(logits, temperature, top_k, top_p, counts, repetition_penalty, frequency_penalty, generator)
+            if counts is not None:
+                counts.scatter_add_(1, idx_next, torch.ones_like(idx_next, dtype=counts.dtype))
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            yield idx_next
+
+    @torch.no_grad()
+    def generate_beam(self, idx, max_new_tokens, beam_width=4, length_penalty=1.0, eos_token=None, use_kv_cache=True):
+        """
+        Beam search: the most likely completion of each of the prompts in idx (LongTensor of shape (b,t)),
+        up to max_new_tokens tokens long. The beams of all prompts are decoded as rows of one batch.
+        A beam that emits eos_token is finished and leaves the batch, which shrinks the beam width of
+        its prompt by one, so a prompt is done once beam_width of its beams finished. Hypotheses are
+        ranked by their log-likelihood divided by (number of new tokens) ** length_penalty.
+        Returns (sequences, scores): a list of b 1-D LongTensors holding prompt and best completion,
+        and a (b,) tensor with their length normalized log-likelihoods.
+        """
+        b, device = idx.size(0), idx.device
+        W = beam_width
+        kv_cache = KVCache(self.config.n_layer, self.config.block_size) if use_kv_cache else None
+        # the live beams, the beams of a prompt are contiguous rows
+        seqs = idx
+        prompt = torch.arange(b, device=device) # prompt of every beam
+        scores = torch.zeros(b, device=device) # summed log-likelihood of the new tokens of every beam
+        finished = [[] for _ in range(b)] # (normalized score, sequence) of the finished hypotheses of every prompt
+        for step in range(max_new_tokens):
+            if kv_cache is None:
+                logits = self(seqs[:, -self.config.block_size:])[0][:, -1, :]
+            else:
+                logits = self.step_logits(seqs, kv_cache)
+            cand = scores.view(-1, 1) + F.log_softmax(logits.float(), dim=-1) # (n, vocab_size)
+            # every beam only has to offer its 2*W best tokens: at most W-1 of them can be eos_token
+            K = min(2 * W, cand.size(-1))
+            beam_scores, beam_tokens = cand.topk(K, dim=-1) # (n, K)
+            # lay the candidates of each prompt out in one row (P, W*K) and rank them together
+            live_prompts, counts = torch.unique_consecutive(prompt, return_counts=True)
+            P = live_prompts.size(0)
+            starts = torch.cumsum(counts, 0) - counts
+            group = torch.repeat_interleave(torch.arange(P, device=device), counts)
+            slot = torch.arange(prompt.size(0), device=device) - starts[group]
+            grid = torch.full((P, W, K), -float('Inf'), device=device)
+            grid[group, slot] = beam_scores
+            top_scores, top_pos = grid.view(P, -1).topk(min(2 * W, W * K), dim=-1)
+            top_rows = starts.view(-1, 1) + top_pos // K
+            top_tokens = beam_tokens[top_rows, top_pos % K]
+            # pick the next beams of every prompt, most likely first, moving eos candidates to finished
+            rows, tokens, new_scores = [], [], []
+            for p, p_rows, p_tokens, p_scores in zip(live_prompts.tolist(), top_rows.tolist(), top_tokens.tolist(), top_scores.tolist()):
+                width = W - len(finished[p])
+                n_live = 0
+                for row, token, score in zip(p_rows, p_tokens, p_scores):
+                    if n_live == width or score == -float('Inf'):
+                        break
+                    if token == eos_token:
+                        finished[p].append((score / (step + 1) ** length_penalty, torch.cat((seqs[row], seqs.new_tensor([token])))))
+                        width -= 1
+                    else:
+                        rows.append(row)
+                        tokens.append(token)
+                        new_scores.append(score)
+                        n_live += 1
+            if not rows:
+                seqs = seqs[:0]
+                break
+            rows = torch.tensor(rows, device=device)
+            seqs = torch.cat((seqs[rows], torch.tensor(tokens, device=device).view(-1, 1)), dim=1)
+            prompt = prompt[rows]
+            scores = torch.tensor(new_scores, device=device)
+            if kv_cache is not None:
+                kv_cache.select(rows)
+        # the beams still running at the end compete with the finished ones
+        n_new = seqs.size(1) - idx.size(1)
+        for p, seq, score in zip(prompt.tolist(), seqs, scores.tolist()):
+            finished[p].append((score / max(n_new, 1) ** length_penalty, seq))
+        best = [max(hyps, key=lambda h: h[0]) for hyps in finished]
+        return [seq for _, seq in best], torch.tensor([score for score, _ in best])
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft, max_new_tokens, num_draft_tokens=4, temperature=1.0, top_k=None, generator=None, stats=None, top_p=None):
+        """
+        Like generate(), but with speculative decoding: the (much cheaper) draft GPT proposes
+        num_draft_tokens tokens, this model scores all of them in a single forward and keeps a prefix
+        of them by rejection sampling, plus one token of its own. The output follows exactly the
+        distribution generate() samples from. Both models must use the same tokenizer, and idx
+        must hold a single sequence (shape (1,t)). If a stats dict is given, the number of 'drafted'
+        and 'accepted' tokens and of target 'forwards' are added to it.
+        """
+        assert idx.size(0) == 1, "speculative decoding only supports a single sequence"
+        block_size, vocab_size = self.config.block_size, self.config.vocab_size
+        kv_cache = KVCache(self.config.n_layer, block_size)
+        draft_kv_cache = KVCache(draft.config.n_layer, draft.config.block_size)
+        stats = stats if stats is not None else {}
+        for key in ('drafted', 'accepted', 'forwards'):
+            stats.setdefault(key, 0)
+        end = idx.size(1) + max_new_tokens
+        while idx.size(1) < end:
+            t = idx.size(1)
+            # draft at most up to max_new_tokens and while everything still fits in the target's context
+            k = min(num_draft_tokens, end - t - 1, block_size - t)
+            if k < 0:
+                # the context slid past block_size, fall back to a plain step on the cropped context
+                logits, _ = self(idx[:, -block_size:])
+                idx_next = torch.multinomial(sampling_probs(logits[:, -1, :], temperature, top_k, top_p), num_samples=1, generator=generator)
+                idx = torch.cat((idx, idx_next), dim=1)
+                stats['forwards'] += 1
+                continue
+            # the draft proposes k tokens autoregressively, remembering its distributions q
+            drafts, q = [], []
+            for _ in range(k):
+                logits = draft._draft_logits(torch.cat([idx] + drafts, dim=1), draft_kv_cache)
+                # line up the draft vocab with ours (they can differ in padding), q only has to be the
+                # distribution the proposals were actually sampled from for the acceptance test to hold
+                q_i = F.pad(logits[0], (0, max(0, vocab_size - logits.size(-1))), value=-float('Inf'))
+                q_i = sampling_probs(q_i[:vocab_size], temperature, top_k, top_p)
+                drafts.append(torch.multinomial(q_i, num_samples=1, generator=generator).view(1, 1))
+                q.append(q_i)
+            # the target scores all proposals in one forward: p[i] is its distribution for token t+i
+            candidate = torch.cat([idx] + drafts, dim=1)
+            logits, _ = self(candidate[:, kv_cache.length:], kv_cache=kv_cache, pos_offset=kv_cache.length, all_logits=True)
+            p = sampling_probs(logits[0, -(k + 1):, :], temperature, top_k, top_p)
+            stats['forwards'] += 1
+            stats['drafted'] += k
+            # accept draft token i with probability min(1, p/q), on the first rejection resample
+            # from the residual max(0, p - q), which makes the accepted sequence distributed like p
+            n = 0
+            while n < k:
+                d = drafts[n].item()
+                if torch.rand(1, generator=generator, device=idx.device).item() * q[n][d] >= p[n, d]:
+                    break
+                n += 1
+            stats['accepted'] += n
+            if n < k:
+                residual = (p[n] - q[n]).clamp(min=0)
+                probs = residual / residual.sum() if residual.sum() > 0 else p[n]
+            else:
+                probs = p[k] # all drafts accepted, so the target's distribution after the last one is free
+            idx_next = torch.multinomial(probs, num_samples=1, generator=generator).view(1, 1)
+            idx = torch.cat([idx] + drafts[:n] + [idx_next], dim=1)
+            # roll the caches back to what is still valid, rejected entries get overwritten later
+            kv_cache.length = idx.size(1) - 1
+            draft_kv_cache.length = min(draft_kv_cache.length, idx.size(1) - 1)
 
         return idx
+
+    def _draft_logits(self, idx, kv_cache):
+        # next-token logits (1, vocab_size) for idx as a draft model, cached while idx fits in the context
+        if idx.size(1) <= self.config.block_size:
+            logits, _ = self(idx[:, kv_cache.length:], kv_cache=kv_cache, pos_offset=kv_cache.length)
+        else:
+            logits, _ = self(idx[:, -self.config.block_size:])
+        return logits[:, -1, :]
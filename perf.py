@@ -0,0 +1,80 @@
+"""
+Performance accounting for train.py and bench.py:
+- peak_flops: the peak matmul FLOPS of the current device and dtype, measured once with a matmul
+  microbenchmark and cached per host in ~/.cache/nanogpt/peak_flops.json
+- step_flops: the FLOPs of the attention, MLP and lm_head matmuls for a forward (and backward) of a
+  (B, T) batch through a GPT with a given config
+- throughput: tokens/sec, achieved FLOPS and utilization of a step from the two above
+"""
+import os
+import json
+import time
+import socket
+import platform
+import torch
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'nanogpt', 'peak_flops.json')
+
+def _device_key(device, dtype):
+    if 'cuda' in str(device):
+        name = torch.cuda.get_device_name(torch.device(device))
+    else:
+        name = f"{platform.processor() or platform.machine()} x{torch.get_num_threads()} threads"
+    return f"{socket.gethostname()}|{name}|{str(dtype).replace('torch.', '')}"
+
+def _matmul_flops(device, dtype, n, iters=10):
+    a = torch.randn(n, n, device=device, dtype=dtype)
+    b = torch.randn(n, n, device=device, dtype=dtype)
+    synchronize = torch.cuda.synchronize if 'cuda' in str(device) else lambda: None
+    best = float('inf')
+    for _ in range(3):
+        a @ b # warmup
+        synchronize()
+        t0 = time.time()
+        for _ in range(iters):
+            a @ b
+        synchronize()
+        best = min(best, (time.time() - t0) / iters)
+    return 2 * n ** 3 / best
+
+def peak_flops(device, dtype, cache_path=CACHE_PATH):
+    """ peak FLOPS of square matmuls on device in dtype, measured on the first call for this host and cached """
+    key = _device_key(device, dtype)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if key not in cache:
+        print(f"calibrating peak FLOPS of {key}...")
+        # big enough to be compute bound, CPUs get there sooner and take longer per matmul
+        cache[key] = _matmul_flops(device, dtype, 8192 if 'cuda' in str(device) else 2048)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    return cache[key]
+
+def step_flops(config, B, T, backward=True):
+    """
+    FLOPs of the matmuls of a (B, T) forward through a GPT with config, per component, backward
+    counted as twice the forward. The attention scores are counted for the full (T, T) matrix.
+    Returns a dict with 'attention', 'mlp', 'lm_head' and 'total'.
+    """
+    C, L = config.n_embd, config.n_layer
+    hs = config.head_size or C // config.n_head
+    q_dim, kv_dim = config.n_head * hs, (config.n_kv_head or config.n_head) * hs
+    hidden = config.mlp_hidden or 4 * C
+    tokens = B * T
+    attention = L * (2 * tokens * C * (q_dim + 2 * kv_dim) # c_attn
+                     + 2 * 2 * B * config.n_head * T * T * hs # q @ k.T and att @ v
+                     + 2 * tokens * q_dim * C) # c_proj
+    mlp = L * 2 * 2 * tokens * C * hidden # c_fc and c_proj
+    lm_head = 2 * tokens * C * config.vocab_size
+    scale = 3 if backward else 1
+    flops = {'attention': scale * attention, 'mlp': scale * mlp, 'lm_head': scale * lm_head}
+    flops['total'] = sum(flops.values())
+    return flops
+
+def throughput(config, B, T, dt, peak, fwdbwd_per_iter=1, backward=True):
+    """ tokens/sec, achieved FLOPS and utilization of peak for fwdbwd_per_iter (B, T) passes taking dt seconds """
+    flops = step_flops(config, B, T, backward)['total'] * fwdbwd_per_iter
+    return {'tokens_per_sec': B * T * fwdbwd_per_iter / dt, 'flops_per_sec': flops / dt, 'mfu': flops / dt / peak}
@@ -0,0 +1,106 @@
+"""
+Background batch loading for train.py and bench.py. PrefetchLoader gathers random (x, y) windows of
+a uint16 token file like get_batch (with a BatchBuilder, see batching.py), but in worker threads
+that run ahead of the training loop, so the model doesn't wait for the memmap reads between micro
+steps. Each worker fills its own small pool of pre-allocated 16 bit (pinned, on CUDA) buffers,
+which are reused once their copy to the device has finished. On the device the batches land in
+two persistent int64 slots, like those of BatchBuilder, so nothing is allocated per batch. Worker w samples from its own
+torch.Generator seeded with seed * num_workers + w, and the batches are taken from the workers in
+turn, so for the same seed and num_workers the sequence of batches doesn't depend on thread timing.
+With an EpochSampler the workers take turns at its batches instead and the seed isn't used.
+"""
+import queue
+import threading
+import numpy as np
+import torch
+
+from batching import BatchBuilder
+
+class PrefetchLoader:
+
+    def __init__(self, path, batch_size, block_size, device, seed, num_workers=1, depth=2, sampler=None):
+        self.builder = BatchBuilder(path, batch_size, block_size, device, slots=0, sampler=sampler)
+        self.batch_size, self.block_size = batch_size, block_size
+        self.device = device
+        self.cuda = 'cuda' in str(device)
+        self.num_workers = num_workers
+        self.ready = [queue.Queue(maxsize=depth) for _ in range(num_workers)] # filled buffers, in order
+        self.free = [queue.Queue() for _ in range(num_workers)] # (buffer, event of the copy out of it)
+        for w in range(num_workers):
+            for _ in range(depth + 1): # depth ready ones plus the one being filled
+                self.free[w].put((self._buffer(), None))
+        # the batch of a slot stays valid until two more batches have been taken, see BatchBuilder
+        shape = (batch_size, block_size + 1)
+        self.slots = [(torch.empty(shape, dtype=torch.int16, device=device) if self.cuda else None,
+                       torch.empty(shape, dtype=torch.int64, device=device)) for _ in range(2)]
+        self.stop = threading.Event()
+        self.k = 0 # batches taken so far
+        self.threads = [threading.Thread(target=self._work, args=(w, seed * num_workers + w), daemon=True) for w in range(num_workers)]
+        for t in self.threads:
+            t.start()
+
+    def _buffer(self):
+        # x and y are the first and last block_size columns, as uint16 bits in int16
+        return torch.empty((self.batch_size, self.block_size + 1), dtype=torch.int16, pin_memory=self.cuda)
+
+    def _get(self, q):
+        # blocks until an item is there or the loader is closed (returns None)
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def _work(self, w, seed):
+        try:
+            g = torch.Generator().manual_seed(seed)
+            k = w # the batch of the sampler this worker builds next
+            while True:
+                item = self._get(self.free[w])
+                if item is None:
+                    return
+                buf, event = item
+                if event is not None:
+                    event.synchronize() # the previous batch in the buffer has been copied to the device
+                self.builder.gather(self.builder.sample(g, k), buf.numpy().view(np.uint16))
+                k += self.num_workers
+                self._put(self.ready[w], buf)
+        except Exception as e:
+            self._put(self.ready[w], e) # raised in the training loop by __next__
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """ the next (x, y) batch on device, x and y are views into a slot the loader reuses """
+        w = self.k % self.num_workers
+        staged, out = self.slots[self.k % len(self.slots)]
+        self.k += 1
+        item = self._get(self.ready[w])
+        if item is None:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        buf = item
+        event = None
+        if self.cuda:
+            staged.copy_(buf, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            staged = buf # the copy into out below is synchronous, buf can go back right after
+        out.copy_(staged).bitwise_and_(0xFFFF) # widened on the device, see batching.py
+        self.free[w].put((buf, event))
+        return out[:, :-1], out[:, 1:]
+
+    def close(self):
+        self.stop.set()
+        for t in self.threads:
+            t.join()
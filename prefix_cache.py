@@ -0,0 +1,104 @@
+"""
+Shared-prompt prefix cache. Keeps the per-layer keys/values of processed prompts so that a later
+request starting with the same tokens only has to forward the part after the shared prefix.
+Entries are keyed on (model identity, hash of the token prefix) and matched at chunk_size token
+boundaries (and at their full length), so a prompt also reuses a cached prompt it only shares a
+beginning with. The least recently used entries are evicted to stay under max_bytes.
+"""
+import weakref
+from collections import OrderedDict
+
+from model import KVCache
+
+class PrefixCache:
+
+    def __init__(self, max_bytes=256 * 1024**2, chunk_size=16):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict() # (model id, hash of all tokens) -> (tokens, KVCache), in LRU order
+        self.index = {} # (model id, hash of a prefix at a boundary) -> keys of all the entries holding it, newest last
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0 # prompt tokens that didn't have to be forwarded
+        self._models = set() # ids of the models with a finalizer that drops their entries
+
+    def lookup(self, model, tokens):
+        """
+        Returns (cache, n): a KVCache whose row 0 holds the keys/values of the first n tokens, for
+        the longest cached prefix of tokens, or (None, 0) on a miss. At least one token is always
+        left over, the logits of the last prompt token are still needed to sample from.
+        """
+        for n, h in reversed(self._boundaries(tokens)):
+            keys = self.index.get((id(model), h))
+            if keys is None:
+                continue
+            key = keys[-1]
+            cached_tokens, cache = self.entries[key]
+            if cached_tokens[:n] != tokens[:n]:
+                continue # hash collision
+            n = min(n, len(tokens) - 1)
+            if n == 0:
+                break
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.hit_tokens += n
+            return cache, n
+        self.misses += 1
+        return None, 0
+
+    def put(self, model, tokens, kv_cache, row=0):
+        # store the keys/values of tokens, held in the given row of kv_cache, as a new entry
+        tokens = list(tokens)
+        boundaries = self._boundaries(tokens)
+        key = (id(model), boundaries[-1][1])
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        n = len(tokens)
+        cache = KVCache(len(kv_cache.k), n)
+        cache.k = [k[row:row+1, :, :n].clone() for k in kv_cache.k]
+        cache.v = [v[row:row+1, :, :n].clone() for v in kv_cache.v]
+        cache.length = n
+        size = sum(t.numel() * t.element_size() for t in cache.k + cache.v)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (tokens, cache)
+        for _, h in boundaries:
+            # older entries sharing the prefix stay indexed, so evicting this one doesn't hide them
+            self.index.setdefault((id(model), h), []).append(key)
+        self.nbytes += size
+        if id(model) not in self._models:
+            self._models.add(id(model))
+            weakref.finalize(model, self._drop_model, id(model))
+        while self.nbytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_tokens=self.hit_tokens,
+                    entries=len(self.entries), bytes=self.nbytes)
+
+    def _boundaries(self, tokens):
+        # [(n, hash of tokens[:n])] for every multiple n of chunk_size and for the full length
+        out, h = [], 0
+        for i in range(0, len(tokens), self.chunk_size):
+            chunk = tuple(tokens[i:i+self.chunk_size])
+            h = hash((h, chunk))
+            out.append((i + len(chunk), h))
+        return out
+
+    def _evict(self, key):
+        tokens, cache = self.entries.pop(key)
+        self.nbytes -= sum(t.numel() * t.element_size() for t in cache.k + cache.v)
+        for _, h in self._boundaries(tokens):
+            keys = self.index.get((key[0], h))
+            if keys is not None and key in keys:
+                keys.remove(key)
+                if not keys:
+                    del self.index[(key[0], h)]
+
+    def _drop_model(self, model_id):
+        # the model is gone (and its id may get reused), so none of its entries can be hit anymore
+        for key in [key for key in self.entries if key[0] == model_id]:
+            self._evict(key)
+        self._models.discard(model_id)
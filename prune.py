@@ -0,0 +1,82 @@
+"""
+Prunes attention heads and MLP channels of a trained model at several sparsity levels (see
+pruning.py). Each pruned model is written as ckpt.pt (no optimizer state, iter_num 0) into
+{out_dir}-pruned{percent}, optionally fine-tuned there for a few iterations by train.py to recover,
+and the report lists params, val loss and CPU tokens/sec of every level next to the original.
+Example:
+$ python prune.py --out_dir=out-shakespeare-char --sparsities=0.25,0.5
+$ python prune.py --out_dir=out_bs64_nl4_nh8_ne256_b16_mi2000_do0.1 --method=activation --finetune_iters=200
+"""
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+import torch
+from inference import load_model
+from pruning import importance, prune_gpt
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # the pruned checkpoints go to {out_dir}-pruned{percent}
+dataset = '' # importance and val loss on data/<dataset>/val.bin, defaults to the checkpoint's dataset
+method = 'taylor' # 'taylor' (activation * gradient) or 'activation' (activation norms, no backward)
+sparsities = '0.25,0.5' # comma separated fractions of the heads and MLP channels of every layer to remove
+score_batches = 8 # val batches the importance is summed over
+batch_size = 8
+eval_iters = 20 # val batches the loss is averaged over
+bench_tokens = 128 # tokens generated (batch 1, kv cache) to measure tokens/sec
+finetune_iters = 0 # > 0: recover each pruned model with this many train.py iterations on the checkpoint's dataset
+seed = 1337
+device = 'cpu'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+model, checkpoint = load_model(init_from, out_dir, device)
+train_config = checkpoint.get('config', {})
+data_dir = os.path.join('data', dataset or train_config.get('dataset', 'openwebtext'))
+data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
+T = model.config.block_size
+
+def get_batches(n, seed):
+    g = torch.Generator().manual_seed(seed)
+    for _ in range(n):
+        ix = torch.randint(len(data) - T, (batch_size,), generator=g)
+        x = torch.stack([torch.from_numpy((data[i:i+T]).astype(np.int64)) for i in ix]).to(device)
+        y = torch.stack([torch.from_numpy((data[i+1:i+1+T]).astype(np.int64)) for i in ix]).to(device)
+        yield x, y
+
+@torch.no_grad()
+def report(name, model):
+    model.eval()
+    # the same val batches for every model, different ones from those the importance was scored on
+    losses = [model(x, y)[1].item() for x, y in get_batches(eval_iters, seed)]
+    x = torch.zeros((1, 1), dtype=torch.long, device=device)
+    model.generate(x, 8, use_kv_cache=True) # warmup
+    t0 = time.time()
+    model.generate(x, bench_tokens, use_kv_cache=True)
+    tokens_per_sec = bench_tokens / (time.time() - t0)
+    print(f"{name:>22s}: {model.get_num_params()/1e6:8.3f}M params, val loss {sum(losses)/len(losses):.4f}, {tokens_per_sec:9.2f} tokens/sec")
+
+report('original', model)
+head_scores, mlp_scores = importance(model, get_batches(score_batches, seed + 1), method)
+for sparsity in [float(s) for s in sparsities.split(',')]:
+    n_head = max(1, round(model.config.n_head * (1 - sparsity)))
+    mlp_hidden = max(1, round(model.transformer.h[0].mlp.c_fc.out_features * (1 - sparsity)))
+    pruned, model_args = prune_gpt(model, head_scores, mlp_scores, n_head, mlp_hidden)
+    pruned_dir = f"{out_dir}-pruned{round(sparsity * 100)}"
+    os.makedirs(pruned_dir, exist_ok=True)
+    state_dict = {k: v for k, v in pruned.state_dict().items() if not k.endswith('.attn.bias')}
+    torch.save({'model': state_dict, 'model_args': model_args, 'iter_num': 0, 'best_val_loss': 1e9, 'config': train_config},
+               os.path.join(pruned_dir, 'ckpt.pt'))
+    report(f"pruned {sparsity:.0%}", pruned)
+    if finetune_iters:
+        # a short run of train.py on the pruned checkpoint, with the hyperparameters of the original run
+        keys = ['dataset', 'batch_size', 'block_size', 'gradient_accumulation_steps', 'learning_rate', 'min_lr', 'beta2', 'weight_decay', 'dropout']
+        args = [f"--{k}={train_config[k]}" for k in keys if k in train_config]
+        args += [f"--out_dir={pruned_dir}", '--init_from=resume', f"--device={device}", '--compile=False',
+                 f"--max_iters={finetune_iters}", f"--lr_decay_iters={finetune_iters}", '--warmup_iters=0',
+                 f"--eval_interval={finetune_iters}", f"--eval_iters={eval_iters}", '--always_save_checkpoint=True']
+        subprocess.run([sys.executable, 'train.py'] + args, check=True)
+        finetuned, _ = load_model('resume', pruned_dir, device, 'ckpt.pt')
+        report(f"pruned {sparsity:.0%} + finetune", finetuned)
@@ -0,0 +1,103 @@
+"""
+Structured pruning of a GPT: attention heads and MLP hidden channels are scored by importance on
+a few batches of text, then the least important ones are physically removed from c_attn, c_proj
+and c_fc, so the pruned GPT is a smaller dense model (GPTConfig.head_size and mlp_hidden record the
+new shapes). Every layer keeps the same number of heads and channels, which ones is decided per layer.
+Importance is either
+- 'taylor': |sum of activation * gradient of the loss| over the unit, the first-order estimate of
+  the change in loss when it is removed
+- 'activation': mean norm of the unit's output times the norm of its c_proj weights, no backward
+"""
+import torch
+
+from model import GPTConfig, GPT
+
+@torch.no_grad()
+def _add_activation_scores(model, acts, head_scores, mlp_scores):
+    for i, block in enumerate(model.transformer.h):
+        y, a = acts[i]['attn'], acts[i]['mlp'] # (B, T, nh*hs), (B, T, hidden)
+        nh, hs = block.attn.n_head, block.attn.head_size
+        w_head = block.attn.c_proj.weight.view(-1, nh, hs).norm(dim=(0, 2)) # (nh,)
+        head_scores[i] += y.view(*y.shape[:2], nh, hs).norm(dim=-1).mean(dim=(0, 1)) * w_head
+        mlp_scores[i] += a.abs().mean(dim=(0, 1)) * block.mlp.c_proj.weight.norm(dim=0)
+
+@torch.no_grad()
+def _add_taylor_scores(model, acts, head_scores, mlp_scores):
+    for i, block in enumerate(model.transformer.h):
+        y, a = acts[i]['attn'], acts[i]['mlp']
+        nh, hs = block.attn.n_head, block.attn.head_size
+        head_scores[i] += (y * y.grad).view(*y.shape[:2], nh, hs).sum(dim=(0, 1, 3)).abs()
+        mlp_scores[i] += (a * a.grad).sum(dim=(0, 1)).abs()
+
+def importance(model, batches, method='taylor'):
+    """
+    Returns (head_scores, mlp_scores), lists with a (n_head,) and a (mlp_hidden,) tensor per layer,
+    summed over batches, an iterable of (x, y) LongTensor pairs.
+    """
+    assert method in ('taylor', 'activation'), f"Unknown importance method: {method}"
+    blocks = model.transformer.h
+    acts = [{} for _ in blocks]
+    def keep(store, key):
+        def hook(module, args, output=None):
+            t = args[0] if output is None else output # the input of c_proj, the output of gelu
+            if method == 'taylor':
+                t.retain_grad()
+            store[key] = t
+        return hook
+    handles = []
+    for i, block in enumerate(blocks):
+        handles.append(block.attn.c_proj.register_forward_pre_hook(keep(acts[i], 'attn')))
+        handles.append(block.mlp.gelu.register_forward_hook(keep(acts[i], 'mlp')))
+    device = next(model.parameters()).device
+    head_scores = [torch.zeros(b.attn.n_head, device=device) for b in blocks]
+    mlp_scores = [torch.zeros(b.mlp.c_fc.out_features, device=device) for b in blocks]
+    was_training = model.training
+    model.eval() # no dropout while scoring
+    try:
+        for x, y in batches:
+            if method == 'taylor':
+                model.zero_grad(set_to_none=True)
+                _, loss = model(x, y)
+                loss.backward()
+                _add_taylor_scores(model, acts, head_scores, mlp_scores)
+            else:
+                with torch.no_grad():
+                    model(x, y)
+                _add_activation_scores(model, acts, head_scores, mlp_scores)
+    finally:
+        for h in handles:
+            h.remove()
+        model.zero_grad(set_to_none=True)
+        model.train(was_training)
+    return [s.cpu() for s in head_scores], [s.cpu() for s in mlp_scores]
+
+@torch.no_grad()
+def prune_gpt(model, head_scores, mlp_scores, n_head, mlp_hidden):
+    """
+    Returns a new GPT (on the device of model) that keeps the n_head most important heads and the
+    mlp_hidden most important MLP channels of every layer of model, and the model_args to rebuild it.
+    """
+    cfg = model.config
+    assert (cfg.n_kv_head or cfg.n_head) == cfg.n_head, "heads of grouped-query attention can't be pruned"
+    hs = cfg.head_size or cfg.n_embd // cfg.n_head
+    model_args = dict(n_layer=cfg.n_layer, n_head=n_head, n_kv_head=0, head_size=hs, mlp_hidden=mlp_hidden, n_embd=cfg.n_embd,
+                      block_size=cfg.block_size, bias=cfg.bias, vocab_size=cfg.vocab_size, dropout=cfg.dropout)
+    pruned = GPT(GPTConfig(**model_args)).to(next(model.parameters()).device)
+    state_dict = {k: v for k, v in model.state_dict().items() if not k.endswith('.attn.bias')} # causal mask buffer
+    q_dim = cfg.n_head * hs
+    for i in range(cfg.n_layer):
+        p = f'transformer.h.{i}.'
+        # rows of the kept heads in each of q, k and v, sorted so the heads stay in their original order
+        heads = head_scores[i].topk(n_head).indices.sort().values
+        rows = (heads.view(-1, 1) * hs + torch.arange(hs)).flatten()
+        rows = torch.cat([rows, rows + q_dim, rows + 2 * q_dim]).to(state_dict[p + 'attn.c_attn.weight'].device)
+        channels = mlp_scores[i].topk(mlp_hidden).indices.sort().values.to(rows.device)
+        for name in ('weight', 'bias'):
+            if p + f'attn.c_attn.{name}' in state_dict:
+                state_dict[p + f'attn.c_attn.{name}'] = state_dict[p + f'attn.c_attn.{name}'][rows]
+                state_dict[p + f'mlp.c_fc.{name}'] = state_dict[p + f'mlp.c_fc.{name}'][channels]
+        state_dict[p + 'attn.c_proj.weight'] = state_dict[p + 'attn.c_proj.weight'][:, rows[:n_head * hs]]
+        state_dict[p + 'mlp.c_proj.weight'] = state_dict[p + 'mlp.c_proj.weight'][:, channels]
+    missing, unexpected = pruned.load_state_dict(state_dict, strict=False)
+    assert not unexpected and all(k.endswith('.attn.bias') for k in missing), f"bad pruned state: {missing}, {unexpected}"
+    return pruned, model_args
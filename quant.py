@@ -0,0 +1,135 @@
+"""
+Weight-only quantized GPT checkpoints (written by export_quantized.py). Every nn.Linear is
+replaced by a QuantLinear that keeps its weight as int8, or as int4 packed two per byte, with
+one fp16 scale per output channel or per group of input channels. The weight is dequantized on
+the fly inside forward, so only the compact form stays resident in memory.
+"""
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from model import GPTConfig, GPT
+
+def quantize_weight(w, bits, group_size=0):
+    """
+    Symmetric round-to-nearest quantization of a (out, in) weight. group_size=0 means one scale
+    per output channel, otherwise one per group of group_size input channels.
+    Returns (qweight, scale): qweight is int8 (out, in) for bits=8 and uint8 (out, in // 2) holding
+    two 4-bit values per byte for bits=4, scale is fp16 (out, n_groups).
+    """
+    assert bits in (8, 4), f"unsupported bits: {bits}"
+    out_features, in_features = w.size()
+    group_size = group_size or in_features
+    assert in_features % group_size == 0, f"group_size {group_size} doesn't divide {in_features}"
+    qmax = 2 ** (bits - 1) - 1
+    w = w.float().view(out_features, in_features // group_size, group_size)
+    scale = (w.abs().amax(dim=-1, keepdim=True) / qmax).clamp(min=1e-8)
+    q = torch.round(w / scale).clamp(-qmax, qmax).to(torch.int8).view(out_features, in_features)
+    if bits == 4:
+        # offset into [0, 15] and pack consecutive input channels into the low/high nibble
+        assert in_features % 2 == 0, "int4 packing needs an even number of input features"
+        q = (q + 8).to(torch.uint8)
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q, scale.squeeze(-1).half()
+
+def dequantize_weight(qweight, scale, bits, dtype=torch.float32):
+    # inverse of quantize_weight, returns the (out, in) weight in dtype
+    if bits == 4:
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        qweight = torch.stack((low, high), dim=-1).view(qweight.size(0), -1)
+    out_features, in_features = qweight.size()
+    w = qweight.to(dtype).view(out_features, scale.size(1), -1) * scale.to(dtype).unsqueeze(-1)
+    return w.view(out_features, in_features)
+
+class QuantLinear(nn.Module):
+    """ nn.Linear with a weight-only quantized weight, see quantize_weight """
+
+    def __init__(self, in_features, out_features, bias, bits, group_size=0, device=None):
+        super().__init__()
+        group_size = group_size or in_features
+        self.in_features, self.out_features = in_features, out_features
+        self.bits, self.group_size = bits, group_size
+        packed_in = in_features if bits == 8 else in_features // 2
+        qdtype = torch.int8 if bits == 8 else torch.uint8
+        self.register_buffer('qweight', torch.empty(out_features, packed_in, dtype=qdtype, device=device))
+        self.register_buffer('scale', torch.empty(out_features, in_features // group_size, dtype=torch.float16, device=device))
+        self.register_buffer('bias', torch.empty(out_features, device=device) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear, bits, group_size=0):
+        q = cls(linear.in_features, linear.out_features, linear.bias is not None, bits, group_size, device=linear.weight.device)
+        q.qweight, q.scale = quantize_weight(linear.weight.detach(), bits, q.group_size)
+        if linear.bias is not None:
+            q.bias = linear.bias.detach().clone()
+        return q
+
+    def weight(self, dtype=torch.float32):
+        return dequantize_weight(self.qweight, self.scale, self.bits, dtype)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.weight(x.dtype), bias)
+
+    def embed(self, idx):
+        # rows of the weight for the token ids idx, for an embedding tied to this layer
+        rows = dequantize_weight(self.qweight[idx.view(-1)], self.scale[idx.view(-1)], self.bits)
+        return rows.view(*idx.shape, self.in_features)
+
+class TiedEmbedding(nn.Module):
+    """ the token embedding of a quantized GPT, looked up in the quantized lm_head it is tied to """
+
+    def __init__(self, linear):
+        super().__init__()
+        # not registered as a submodule, so its buffers are only saved/loaded once under lm_head
+        self.__dict__['linear'] = linear
+
+    def forward(self, idx):
+        return self.linear.embed(idx)
+
+def _quantize_linears(model, make):
+    # replace every nn.Linear of the model by make(name, linear) and tie wte to the new lm_head
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, child_name, make(f"{name}.{child_name}".lstrip('.'), child))
+    model.transformer.wte = TiedEmbedding(model.lm_head)
+    return model
+
+def quantize_gpt(model, bits, group_size=0):
+    """ quantizes the Linear weights of a GPT in place, returns it """
+    return _quantize_linears(model, lambda name, linear: QuantLinear.from_linear(linear, bits, group_size))
+
+def quantized_checkpoint(model, checkpoint, bits, group_size=0):
+    """
+    Returns the weight-only quantized checkpoint dict of a (fp32) GPT, with the model_args and
+    config of its training checkpoint but without the optimizer state. model is quantized in place.
+    """
+    quantize_gpt(model, bits, group_size)
+    state_dict = {k: v for k, v in model.state_dict().items() if not k.endswith('.attn.bias')} # causal mask buffer
+    return {
+        'model': state_dict,
+        'model_args': checkpoint['model_args'],
+        'config': checkpoint.get('config', {}),
+        'quantization': dict(bits=bits, group_size=group_size),
+    }
+
+def load_quantized(checkpoint, device):
+    """
+    Rebuilds a GPT in eval mode from a quantized checkpoint dict without ever materializing the
+    fp32 Linear weights: the model is built on the meta device and only then allocated.
+    """
+    bits, group_size = checkpoint['quantization']['bits'], checkpoint['quantization']['group_size']
+    config = GPTConfig(**checkpoint['model_args'])
+    with torch.device('meta'):
+        model = GPT(config)
+        _quantize_linears(model, lambda name, linear: QuantLinear(linear.in_features, linear.out_features,
+                                                                  linear.bias is not None, bits, group_size))
+    model.to_empty(device=device)
+    missing, unexpected = model.load_state_dict(checkpoint['model'], strict=False)
+    assert not unexpected and all(k.endswith('.attn.bias') for k in missing), f"bad quantized checkpoint: {missing}, {unexpected}"
+    for block in model.transformer.h:
+        if hasattr(block.attn, 'bias'):
+            # the causal mask of the slow attention path isn't stored, rebuild it
+            block.attn.bias.copy_(torch.tril(torch.ones_like(block.attn.bias)))
+    model.eval()
+    return model
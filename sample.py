@@ -1,27 +1,37 @@
 """
 Sample from a trained model
 """
-import os
-import pickle
 from contextlib import nullcontext
+import time
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from inference import load_model, load_tokenizer, load_token_bytes, quantize_model, StreamDecoder
 device = 'cpu'
 
 
 # -----------------------------------------------------------------------------
-init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+init_from = 'resume' # either 'resume' (from an out_dir), 'exported' (out_dir/exported from export_program.py) or a gpt2 variant (e.g. 'gpt2-xl')
 out_dir = 'out' # ignored if init_from is not 'resume'
+ckpt_name = '' # checkpoint file in out_dir, e.g. a ckpt_int4.pt written by export_quantized.py, default: ckpt.mmap if up to date, else ckpt.pt
 start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
 num_samples = 10 # number of samples to draw
 max_new_tokens = 500 # number of tokens generated in each sample
 temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+top_p = 1.0 # nucleus sampling: retain only the most likely tokens that add up to top_p probability, 1.0 = off
+repetition_penalty = 1.0 # > 1.0 makes tokens already in the context less likely, 1.0 = off
+frequency_penalty = 0.0 # subtracted from a token's logit once for every time it occurs in the context, 0.0 = off
 seed = 1337
 #device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+quantize = False # run the Linear layers as int8 dynamically quantized linears, CPU only
+kv_cache = True # cache past keys/values so each generation step only forwards the newest token
+window_stride = 1 # past block_size, slide the context window by this many tokens at a time, the cache is only rebuilt then
+batched = True # generate the samples as rows of one batch instead of one generate call per sample
+stream = False # print every sample token by token as it is generated, and report the time to first token
+micro_batch_size = 16 # max number of samples per batched generate call, bounds the memory with large models
+draft_out_dir = '' # if set, decode with speculative decoding using the (smaller) checkpoint in this out_dir as draft
+num_draft_tokens = 4 # number of tokens the draft model proposes per target forward
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -34,46 +44,19 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
-if init_from == 'resume':
-    # init from a model saved in a specific directory
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=torch.device('cpu'))
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
-elif init_from.startswith('gpt2'):
-    # init from a given GPT-2 model
-    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
-
-model.eval()
-model.to(device)
+model, checkpoint = load_model(init_from, out_dir, device, ckpt_name)
+if quantize:
+    model = quantize_model(model)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
-
-# look for the meta pickle in case it is available in the dataset folder
-load_meta = False
-if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
-    meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
-    load_meta = os.path.exists(meta_path)
-if load_meta:
-    print(f"Loading meta from {meta_path}...")
-    with open(meta_path, 'rb') as f:
-        meta = pickle.load(f)
-    # TODO want to make this more general to arbitrary encoder/decoder schemes
-    stoi, itos = meta['stoi'], meta['itos']
-    encode = lambda s: [stoi[c] for c in s]
-    decode = lambda l: ''.join([itos[i] for i in l])
-else:
-    # ok let's assume gpt-2 encodings by default
-    print("No meta.pkl found, assuming GPT-2 encodings...")
-    enc = tiktoken.get_encoding("gpt2")
-    encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
-    decode = lambda l: enc.decode(l)
+encode, decode = load_tokenizer(checkpoint)
+if draft_out_dir:
+    # the draft has to be trained on the same tokenizer, it only proposes tokens the target then verifies
+    draft, _ = load_model('resume', draft_out_dir, device)
+    if quantize:
+        draft = quantize_model(draft)
+    if compile:
+        draft = torch.compile(draft)
 
 # encode the beginning of the prompt
 if start.startswith('FILE:'):
@@ -85,7 +68,55 @@ x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
 # run generation
 with torch.no_grad():
     with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
+        if stream:
+            # one sample at a time, each token printed as soon as it is sampled
+            token_bytes = load_token_bytes(checkpoint)
+            ttft, total = [], []
+            for k in range(num_samples):
+                generator = torch.Generator(device=device).manual_seed(seed + k)
+                decoder = StreamDecoder(token_bytes)
+                print(start, end='', flush=True)
+                t0 = time.time()
+                for i, idx_next in enumerate(model.generate_stream(x, max_new_tokens, temperature=temperature, top_k=top_k, top_p=top_p,
+                                                                   repetition_penalty=repetition_penalty, frequency_penalty=frequency_penalty,
+                                                                   use_kv_cache=kv_cache, window_stride=window_stride, generator=generator)):
+                    if i == 0:
+                        ttft.append(time.time() - t0)
+                    print(decoder.push(idx_next.item()), end='', flush=True)
+                print(decoder.flush())
+                total.append(time.time() - t0)
+                print('---------------')
+            if ttft:
+                print(f"time to first token: {sum(ttft) / len(ttft) * 1000:.2f}ms, time to full sample: {sum(total) / len(total) * 1000:.2f}ms")
+        elif draft_out_dir:
+            # speculative decoding works on one sequence at a time, report how much of the draft was kept
+            stats = {}
+            t0 = time.time()
+            for k in range(num_samples):
+                generator = torch.Generator(device=device).manual_seed(seed + k)
+                y = model.generate_speculative(x, draft, max_new_tokens, num_draft_tokens=num_draft_tokens,
+                                               temperature=temperature, top_k=top_k, top_p=top_p, generator=generator, stats=stats)
+                print(decode(y[0].tolist()))
+                print('---------------')
+            dt = time.time() - t0
+            print(f"acceptance rate: {stats['accepted'] / max(stats['drafted'], 1) * 100:.2f}% ({stats['accepted']}/{stats['drafted']} drafted tokens), "
+                  f"{num_samples * max_new_tokens / stats['forwards']:.2f} tokens per target forward, "
+                  f"{num_samples * max_new_tokens / dt:.2f} tokens/sec")
+        elif batched:
+            # each sample k has its own RNG stream seeded with seed+k, so results don't depend on micro_batch_size
+            for k0 in range(0, num_samples, micro_batch_size):
+                n = min(micro_batch_size, num_samples - k0)
+                generators = [torch.Generator(device=device).manual_seed(seed + k0 + k) for k in range(n)]
+                y = model.generate(x.expand(n, -1), max_new_tokens, temperature=temperature, top_k=top_k, top_p=top_p,
+                                   repetition_penalty=repetition_penalty, frequency_penalty=frequency_penalty,
+                                   use_kv_cache=kv_cache, window_stride=window_stride, generator=generators)
+                for row in y.tolist():
+                    print(decode(row))
+                    print('---------------')
+        else:
+            for k in range(num_samples):
+                y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, top_p=top_p,
+                                   repetition_penalty=repetition_penalty, frequency_penalty=frequency_penalty,
+                                   use_kv_cache=kv_cache, window_stride=window_stride)
+                print(decode(y[0].tolist()))
+                print('---------------')
@@ -0,0 +1,112 @@
+"""
+The sampling step of generation, shared by GPT.generate, the speculative decoder and the
+continuous batching scheduler. Every parameter is either a scalar for the whole batch or a
+per-row (b,) tensor/list, and all of them are applied to the batch at once:
+- temperature
+- repetition_penalty (CTRL style: the logits of tokens already in the context are divided by it
+  if positive, multiplied if negative) and frequency_penalty (subtracted once per occurrence),
+  both need the (b, vocab_size) token counts of the context
+- top_k and top_p (nucleus) truncation, done on the topk of the largest per-row k instead of
+  comparing/sorting over the whole vocab, so the cost scales with k. Rows with top_p but no
+  top_k still need a sort over the vocab. With one seeded generator per row, each row draws from
+  its own nonzero candidates only, which don't depend on the other rows of the batch.
+"""
+import torch
+from torch.nn import functional as F
+
+def _rows(x, b, device, dtype, default=None):
+    # a per-row parameter as a (b,) tensor, None where all rows are at the default (i.e. a no-op)
+    if x is None:
+        return None
+    if not torch.is_tensor(x):
+        if isinstance(x, (list, tuple)):
+            x = [default if v is None else v for v in x]
+        x = torch.tensor(x, dtype=dtype, device=device)
+    x = x.to(device=device, dtype=dtype)
+    x = x.expand(b) if x.dim() == 0 or x.size(0) == 1 else x
+    if default is not None and bool((x == default).all()):
+        return None
+    return x
+
+def uses_penalties(repetition_penalty=None, frequency_penalty=None):
+    """ whether any row has a penalty set, i.e. sampling needs the token counts of the context """
+    return (_rows(repetition_penalty, 1, 'cpu', torch.float32, default=1.0) is not None or
+            _rows(frequency_penalty, 1, 'cpu', torch.float32, default=0.0) is not None)
+
+def token_counts(idx, vocab_size):
+    """ (b, vocab_size) number of occurrences of every token in each row of idx (b, t) """
+    counts = torch.zeros(idx.size(0), vocab_size, dtype=torch.float32, device=idx.device)
+    return counts.scatter_add_(1, idx, torch.ones_like(idx, dtype=torch.float32))
+
+def adjust_logits(logits, temperature=1.0, counts=None, repetition_penalty=None, frequency_penalty=None):
+    """ applies the penalties and the temperature to logits (b, vocab_size), returns a new tensor """
+    b = logits.size(0)
+    rep = _rows(repetition_penalty, b, logits.device, logits.dtype, default=1.0)
+    freq = _rows(frequency_penalty, b, logits.device, logits.dtype, default=0.0)
+    if rep is not None or freq is not None:
+        assert counts is not None, "penalties need the token counts of the context"
+        if rep is not None:
+            rep = rep.view(-1, 1)
+            penalized = torch.where(logits > 0, logits / rep, logits * rep)
+            logits = torch.where(counts > 0, penalized, logits)
+        if freq is not None:
+            logits = logits - freq.view(-1, 1) * counts
+    if torch.is_tensor(temperature) or isinstance(temperature, (list, tuple)):
+        return logits / _rows(temperature, b, logits.device, logits.dtype).view(-1, 1)
+    return logits / temperature
+
+def candidates(logits, top_k=None, top_p=None):
+    """
+    The distribution to sample from after top_k/top_p truncation of logits (b, vocab_size).
+    Returns (probs, ids): probs (b, k) over the token ids ids (b, k), where k is the largest
+    top_k of the batch and the entries beyond a row's own top_k/top_p have probability 0.
+    Without any truncation ids is None and probs covers the whole vocab.
+    """
+    b, V = logits.size()
+    top_k = _rows(top_k, b, logits.device, torch.long, default=V)
+    top_p = _rows(top_p, b, logits.device, logits.dtype, default=1.0)
+    if top_k is None and top_p is None:
+        return F.softmax(logits, dim=-1), None
+    k = top_k.clamp(1, V) if top_k is not None else None
+    k_max = int(k.max()) if k is not None else V
+    values, ids = torch.topk(logits, k_max, dim=-1) # sorted, largest first
+    if k is not None and bool((k < k_max).any()):
+        values = values.masked_fill(torch.arange(k_max, device=logits.device) >= k.view(-1, 1), -float('Inf'))
+    probs = F.softmax(values, dim=-1)
+    if top_p is not None:
+        # keep the smallest prefix whose mass reaches top_p, the most likely token always stays
+        cum = probs.cumsum(dim=-1)
+        probs = probs.masked_fill(cum - probs >= top_p.view(-1, 1), 0.0)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+    return probs, ids
+
+def sampling_probs(logits, temperature=1.0, top_k=None, top_p=None, counts=None, repetition_penalty=None, frequency_penalty=None):
+    """ the full (..., vocab_size) distribution sample() draws from, for logits (..., vocab_size) """
+    shape = logits.shape
+    logits = adjust_logits(logits.reshape(-1, shape[-1]), temperature, counts, repetition_penalty, frequency_penalty)
+    probs, ids = candidates(logits, top_k, top_p)
+    if ids is not None:
+        probs = torch.zeros_like(logits).scatter_(-1, ids, probs)
+    return probs.view(shape)
+
+def sample(logits, temperature=1.0, top_k=None, top_p=None, counts=None, repetition_penalty=None, frequency_penalty=None, generator=None):
+    """
+    Samples the next token (b, 1) from logits (b, vocab_size). generator is an optional
+    torch.Generator, or a list of them with one per row so that every row is drawn from its own
+    RNG stream and doesn't depend on what else is in the batch.
+    """
+    logits = adjust_logits(logits, temperature, counts, repetition_penalty, frequency_penalty)
+    probs, ids = candidates(logits, top_k, top_p)
+    if generator is None:
+        idx_next = torch.multinomial(probs, num_samples=1)
+        return idx_next if ids is None else ids.gather(1, idx_next)
+    if isinstance(generator, torch.Generator):
+        idx_next = torch.multinomial(probs, num_samples=1, generator=generator)
+        return idx_next if ids is None else ids.gather(1, idx_next)
+    if ids is None:
+        return torch.cat([torch.multinomial(p, num_samples=1, generator=g) for p, g in zip(probs, generator)]).view(-1, 1)
+    # the number of candidates (k_max) depends on the other rows of the batch, so every row only
+    # draws from its own: the candidates are sorted and truncation zeroes a suffix, so that's the
+    # nonzero prefix, and the draw costs O(k) instead of O(vocab_size) per row
+    n = (probs > 0).sum(dim=-1).tolist()
+    return torch.stack([i[:m][torch.multinomial(p[:m], num_samples=1, generator=g)] for p, i, m, g in zip(probs, ids, n, generator)])
@@ -0,0 +1,172 @@
+"""
+Continuous batching for GPT decoding. All running requests share one decode batch:
+a new request joins it at the next token boundary (after a prefill of its prompt) and a
+finished one leaves it right away, so nobody waits for a whole generate() call of others.
+Row i of the batch (and of the shared KVCache) always belongs to active[i]; when a request
+finishes, the last row is moved into its place to keep the live rows contiguous.
+"""
+import time
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from model import KVCache
+from sampling import sample
+
+@dataclass
+class Request:
+    prompt: list # token ids
+    max_new_tokens: int = 100
+    temperature: float = 1.0
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    seed: Optional[int] = None
+    # filled in by the scheduler
+    tokens: list = field(default_factory=list) # generated token ids
+    t_submit: float = 0.0
+    t_first_token: float = 0.0
+    t_done: float = 0.0
+    error: Optional[str] = None # set if the request failed, done is set either way
+    done: threading.Event = field(default_factory=threading.Event)
+
+class Scheduler:
+
+    def __init__(self, model, max_batch_size=16, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache # optional PrefixCache, prompts sharing a cached prefix skip its prefill
+        self.config = model.config
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+        self.queue = queue.Queue() # submitted requests waiting to join the batch
+        self.active = [] # running requests, in batch row order
+        self.kv_cache = KVCache(self.config.n_layer, self.config.block_size)
+        # per-row decoding state, only the first len(self.active) rows are live
+        self.lengths = torch.zeros(max_batch_size, dtype=torch.long, device=self.device) # cached positions
+        self.last = torch.zeros(max_batch_size, 1, dtype=torch.long, device=self.device) # input of the next step
+        self.temperature = torch.ones(max_batch_size, device=self.device)
+        self.top_k = torch.full((max_batch_size,), self.config.vocab_size, dtype=torch.long, device=self.device)
+        self.top_p = torch.ones(max_batch_size, device=self.device)
+        self.generators = [None] * max_batch_size
+
+    def submit(self, req):
+        assert req.temperature > 0, "temperature must be positive"
+        assert req.top_p is None or 0 < req.top_p <= 1, "top_p must be in (0, 1]"
+        assert req.top_k is None or (isinstance(req.top_k, int) and req.top_k > 0), "top_k must be a positive integer"
+        assert req.seed is None or (isinstance(req.seed, int) and req.seed >= 0), "seed must be a non-negative integer"
+        # leave room for the new tokens inside the context window, cropping the prompt if needed
+        req.max_new_tokens = max(1, min(req.max_new_tokens, self.config.block_size - 1))
+        req.prompt = req.prompt[-(self.config.block_size - req.max_new_tokens):]
+        assert len(req.prompt) > 0, "prompt must not be empty"
+        req.t_submit = time.time()
+        self.queue.put(req)
+        return req
+
+    @torch.no_grad()
+    def step(self, block=False):
+        """
+        Admit waiting requests into free rows, then run one decode step for the whole batch.
+        With block=True, waits for a request to arrive while the batch is empty.
+        Returns False if there was nothing to do.
+        """
+        while len(self.active) < self.max_batch_size:
+            try:
+                req = self.queue.get(block=block and not self.active, timeout=0.1)
+            except queue.Empty:
+                break
+            try:
+                self._prefill(req)
+            except Exception as e:
+                # only this request fails, the rest of the batch goes on without it
+                if self.active and self.active[-1] is req:
+                    self.active.pop()
+                self._fail(req, e)
+        self._retire()
+        if not self.active:
+            return False
+        n = len(self.active)
+        logits, _ = self.model(self.last[:n], kv_cache=self.kv_cache, pos_offset=self.lengths[:n])
+        self.lengths[:n] += 1
+        rows = slice(0, n)
+        self._append(self._sample(logits[:, -1, :], rows), rows)
+        self._retire()
+        return True
+
+    def run(self, stop_event, ctx):
+        # serve until stop_event is set, ctx is the autocast context (thread-local, so entered here)
+        with ctx:
+            while not stop_event.is_set():
+                try:
+                    self.step(block=True)
+                except Exception as e:
+                    # a failed decode step can't be pinned on one request, fail the whole batch instead of hanging it
+                    for req in self.active:
+                        self._fail(req, e)
+                    self.active = []
+
+    def _fail(self, req, e):
+        print(f"request failed: {e!r}")
+        req.error = repr(e)
+        req.t_done = time.time()
+        req.done.set()
+
+    def _prefill(self, req):
+        # forward the prompt into a fresh single row cache, then copy it into the next free row
+        row = len(self.active)
+        cache = KVCache(self.config.n_layer, self.config.block_size)
+        n = 0
+        if self.prefix_cache is not None:
+            cached, n = self.prefix_cache.lookup(self.model, req.prompt)
+            if cached is not None:
+                cache.insert(0, cached, n)
+        idx = torch.tensor([req.prompt[n:]], dtype=torch.long, device=self.device)
+        logits, _ = self.model(idx, kv_cache=cache, pos_offset=n)
+        if self.prefix_cache is not None:
+            self.prefix_cache.put(self.model, req.prompt, cache)
+        self.kv_cache.insert(row, cache, len(req.prompt))
+        self.lengths[row] = len(req.prompt)
+        self.temperature[row] = req.temperature
+        self.top_k[row] = min(req.top_k or self.config.vocab_size, self.config.vocab_size)
+        self.top_p[row] = req.top_p if req.top_p is not None else 1.0
+        self.generators[row] = None
+        if req.seed is not None:
+            self.generators[row] = torch.Generator(device=self.device).manual_seed(req.seed)
+        self.active.append(req)
+        rows = slice(row, row + 1)
+        self._append(self._sample(logits[:, -1, :], rows), rows)
+
+    def _sample(self, logits, rows):
+        # sample the next token for a slice of rows, each with its own temperature, top_k, top_p and RNG stream
+        generators = self.generators[rows]
+        if all(g is None for g in generators):
+            generators = None # no seeded row, sample the whole slice in one vectorized draw
+        idx_next = sample(logits, self.temperature[rows], self.top_k[rows], self.top_p[rows], generator=generators)
+        return idx_next.view(-1)
+
+    def _append(self, idx_next, rows):
+        # record the tokens sampled for a slice of rows
+        now = time.time()
+        for row, tok in zip(range(rows.start, rows.stop), idx_next.tolist()):
+            req = self.active[row]
+            if not req.tokens:
+                req.t_first_token = now
+            req.tokens.append(tok)
+            self.last[row, 0] = tok
+
+    def _retire(self):
+        # remove the finished requests, going backwards so the last row is always a live one
+        for row in reversed(range(len(self.active))):
+            req = self.active[row]
+            if len(req.tokens) < req.max_new_tokens:
+                continue
+            last = len(self.active) - 1
+            if row != last:
+                self.kv_cache.move(last, row, int(self.lengths[last]))
+                for buf in (self.lengths, self.last, self.temperature, self.top_k, self.top_p):
+                    buf[row] = buf[last]
+                self.generators[row] = self.generators[last]
+                self.active[row] = self.active[last]
+            self.active.pop()
+            req.t_done = time.time()
+            req.done.set()
@@ -0,0 +1,58 @@
+"""
+Score texts with a trained model: the log-likelihood and perplexity of every text, all texts
+batched together (see scoring.py). input is a text file with one text per line, or a .jsonl file
+of {"text": ...} objects, optionally with a "context" the text is conditioned on but that isn't scored.
+Writes one JSON line per text to output (stdout if empty), the perplexity over all texts at the end.
+$ python score.py --out_dir=out-shakespeare-char --input=texts.txt
+"""
+import sys
+import json
+from contextlib import nullcontext
+import torch
+from inference import load_model, load_tokenizer
+from scoring import score, perplexity
+device = 'cpu'
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is not 'resume'
+ckpt_name = '' # checkpoint file in out_dir, default: ckpt.mmap if up to date, else ckpt.pt
+input = 'texts.txt' # one text per line, or a .jsonl file with "text" and optional "context" fields
+output = '' # file to write the scores to, stdout if empty
+batch_tokens = 8192 # max number of tokens (padding included) per forward, bounds the memory of the logits
+token_logprobs = False # also write the log-prob of every scored token
+#device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+model, checkpoint = load_model(init_from, out_dir, device, ckpt_name)
+encode, decode = load_tokenizer(checkpoint)
+
+# texts and their (unscored) contexts
+with open(input, 'r', encoding='utf-8') as f:
+    if input.endswith('.jsonl'):
+        records = [json.loads(line) for line in f if line.strip()]
+    else:
+        records = [{'text': line.rstrip('\n')} for line in f]
+contexts = [encode(r.get('context', '')) for r in records]
+sequences = [c + encode(r['text']) for c, r in zip(contexts, records)]
+
+with ctx:
+    per_token, logprobs, counts = score(model, sequences, [len(c) for c in contexts], batch_tokens)
+
+out = open(output, 'w', encoding='utf-8') if output else sys.stdout
+for r, lp, logprob, n in zip(records, per_token, logprobs.tolist(), counts.tolist()):
+    result = {'text': r['text'], 'num_tokens': n, 'logprob': logprob, 'perplexity': perplexity(torch.tensor([logprob]), torch.tensor([n]))}
+    if token_logprobs:
+        result['token_logprobs'] = lp.tolist()
+    out.write(json.dumps(result) + '\n')
+if output:
+    out.close()
+print(f"{len(records)} texts, {counts.sum().item()} tokens scored, perplexity {perplexity(logprobs, counts):.4f}", file=sys.stderr)
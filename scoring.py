@@ -0,0 +1,61 @@
+"""
+Batched log-likelihood scoring of token sequences with a GPT. The sequences are cut into pieces
+of at most block_size predictions, sorted by length and packed into right-padded batches of at
+most batch_tokens tokens. Targets that are padding or part of a sequence's context are set to the
+ignore_index -1 like in GPT.forward. With causal attention the padding after a piece never
+reaches its real positions, so the results don't depend on how pieces are batched (up to float
+rounding of the different matmul shapes).
+"""
+import math
+import torch
+from torch.nn import functional as F
+
+@torch.no_grad()
+def score(model, sequences, num_context=None, batch_tokens=8192):
+    """
+    Log-likelihoods of sequences (lists of token ids) under model, every token conditioned on the
+    ones before it. The first num_context[i] tokens of sequence i (at least its first token, which
+    has nothing to condition on) are only context and not scored. A sequence longer than
+    block_size + 1 is scored in consecutive windows, the context restarts at every window.
+    Returns (token_logprobs, logprobs, counts): for every sequence a 1-D tensor with the log-prob
+    of each scored token, and (n,) tensors with their sums and numbers.
+    """
+    block_size = model.config.block_size
+    device = next(model.parameters()).device
+    num_context = num_context or [0] * len(sequences)
+    # pieces (sequence, position of its first target, inputs, targets)
+    pieces = []
+    for i, (seq, n_ctx) in enumerate(zip(sequences, num_context)):
+        for s in range(0, max(len(seq) - 1, 0), block_size):
+            inputs = seq[s:s + block_size]
+            targets = [t if s + 1 + j >= n_ctx else -1 for j, t in enumerate(seq[s + 1:s + 1 + block_size])]
+            pieces.append((i, s, inputs, targets))
+    # bucket by length, so a batch holds pieces of about the same length and little padding
+    pieces.sort(key=lambda p: len(p[2]), reverse=True)
+    token_logprobs = [torch.zeros(max(len(seq) - 1, 0)) for seq in sequences]
+    scored = [torch.zeros(max(len(seq) - 1, 0), dtype=torch.bool) for seq in sequences]
+    start = 0
+    while start < len(pieces):
+        T = len(pieces[start][2])
+        end = start + max(1, batch_tokens // T)
+        batch = pieces[start:end]
+        x = torch.zeros(len(batch), T, dtype=torch.long)
+        y = torch.full((len(batch), T), -1, dtype=torch.long)
+        for row, (_, _, inputs, targets) in enumerate(batch):
+            x[row, :len(inputs)] = torch.tensor(inputs)
+            y[row, :len(targets)] = torch.tensor(targets)
+        x, y = x.to(device), y.to(device)
+        logits, _ = model(x, all_logits=True)
+        logp = F.log_softmax(logits.float(), dim=-1).gather(-1, y.clamp(min=0).unsqueeze(-1)).squeeze(-1).cpu()
+        for row, (i, s, _, targets) in enumerate(batch):
+            token_logprobs[i][s:s + len(targets)] = logp[row, :len(targets)]
+            scored[i][s:s + len(targets)] = torch.tensor(targets) != -1
+        start = end
+    token_logprobs = [lp[mask] for lp, mask in zip(token_logprobs, scored)]
+    logprobs = torch.tensor([lp.sum().item() for lp in token_logprobs])
+    counts = torch.tensor([lp.numel() for lp in token_logprobs])
+    return token_logprobs, logprobs, counts
+
+def perplexity(logprobs, counts):
+    """ perplexity of the scored tokens of all sequences together """
+    return math.exp(-logprobs.sum().item() / max(counts.sum().item(), 1))
@@ -0,0 +1,108 @@
+"""
+Serve completions from a trained model over HTTP/JSON, with continuous batching
+(see scheduler.py): requests join the running decode batch at token boundaries.
+$ python server.py --out_dir=out-shakespeare-char --port=8000
+$ curl -s localhost:8000/generate -d '{"prompt": "ROMEO:", "max_new_tokens": 100, "temperature": 0.8, "top_k": 200, "top_p": 0.95}'
+Every field but prompt is optional, an integer "seed" makes the request reproducible.
+GET /stats returns the hit/miss counters of the shared-prompt prefix cache.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import nullcontext
+import torch
+from inference import load_model, load_tokenizer
+from scheduler import Request, Scheduler
+from prefix_cache import PrefixCache
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is not 'resume'
+host = '127.0.0.1'
+port = 8000
+max_batch_size = 16 # max number of requests decoded together, the rest wait in the queue
+max_new_tokens = 500 # default and upper limit of the per-request max_new_tokens
+temperature = 0.8 # default of the per-request temperature
+top_k = 200 # default of the per-request top_k
+top_p = 1.0 # default of the per-request top_p (nucleus sampling), 1.0 keeps the whole distribution
+prefix_cache_mb = 256 # memory budget of the cache of prompt prefix keys/values, 0 disables it
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+# model
+model, checkpoint = load_model(init_from, out_dir, device)
+if compile:
+    model = torch.compile(model) # requires PyTorch 2.0 (optional)
+encode, decode = load_tokenizer(checkpoint)
+
+prefix_cache = PrefixCache(max_bytes=prefix_cache_mb * 1024**2) if prefix_cache_mb > 0 else None
+scheduler = Scheduler(model, max_batch_size=max_batch_size, prefix_cache=prefix_cache)
+
+def int_field(body, key, default):
+    # JSON integers only, '5', 5.5 or true are rejected instead of failing later on the scheduler thread
+    value = body.get(key, default)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise ValueError(f"{key} must be an integer, got {value!r}")
+    return value
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        self.reply(200, {'prefix_cache': prefix_cache.stats() if prefix_cache is not None else None})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            req = Request(
+                prompt=encode(body['prompt']),
+                max_new_tokens=min(int(body.get('max_new_tokens', max_new_tokens)), max_new_tokens),
+                temperature=float(body.get('temperature', temperature)),
+                top_k=int_field(body, 'top_k', top_k),
+                top_p=float(body.get('top_p', top_p)),
+                seed=int_field(body, 'seed', None),
+            )
+            scheduler.submit(req)
+        except (KeyError, ValueError, TypeError, AssertionError) as e:
+            return self.reply(400, {'error': f"bad request: {e!r}"})
+        req.done.wait()
+        if req.error is not None:
+            return self.reply(500, {'error': f"generation failed: {req.error}"})
+        self.reply(200, {
+            'text': decode(req.tokens),
+            'completion_tokens': len(req.tokens),
+            'time_to_first_token_ms': (req.t_first_token - req.t_submit) * 1000,
+            'latency_ms': (req.t_done - req.t_submit) * 1000,
+        })
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+stop = threading.Event()
+threading.Thread(target=scheduler.run, args=(stop, ctx), daemon=True).start()
+httpd = ThreadingHTTPServer((host, port), Handler)
+print(f"serving on http://{host}:{port}/generate")
+try:
+    httpd.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    stop.set()
+    httpd.server_close()
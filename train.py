@@ -22,12 +22,16 @@ import math
 import pickle
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from distill import distillation_loss
+from perf import peak_flops, throughput
+from prefetch import PrefetchLoader
+from batching import BatchBuilder, EpochSampler
+from mmap_ckpt import find_checkpoint, load_mmap_model
 
 # ----------------------------------------------------------------------------- #
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -50,14 +54,26 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8
 batch_size = 12
 block_size = 1024
+prefetch = 0 # > 0: build the train batches in background threads, up to this many batches ahead per worker
+prefetch_workers = 1 # threads building batches when prefetch > 0
+epoch_sampler = False # train on every non-overlapping window once per epoch, disjoint across DDP ranks, resumable
 
 # model
 n_layer = 12
 n_head = 12
+n_kv_head = 0 # key/value heads shared by groups of query heads (grouped-query attention), 0: n_head
 n_embd = 768
 dropout = 0.0
 bias = False
-
+attn_block_size = 0 # > 0: blockwise attention over tiles of this many positions, for when there is no flash attention
+activation_checkpointing = 0 # recompute the activations of every k-th Block in backward to save memory, 0: none, 1: all
+loss_chunk_size = 0 # > 0: fused lm_head + cross-entropy over chunks of this many positions, never builds the full logits
+
+# distillation
+teacher = '' # if set, distill from this teacher: a gpt2 variant (e.g. 'gpt2-medium') or an out_dir with its checkpoint
+distill_alpha = 0.5 # weight of the KL to the teacher in the loss, the cross-entropy gets 1 - distill_alpha
+distill_temperature = 2.0 # softens the teacher and student distributions in the KL
+distill_chunk_size = 1024 # positions per chunk of the distillation loss, the full logits are never formed
 # adamw optimizer
 learning_rate = 6e-4
 max_iters = 600000
@@ -118,19 +134,28 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 # -----------------------------------------------------------------------------
 # Data loader
 data_dir = os.path.join('data', dataset)
+# the memmaps are opened once, each batch is one vectorized read of the sampled windows (batching.py)
+train_path = os.path.join(data_dir, 'train.bin')
+train_sampler = None
+if epoch_sampler:
+    # instead of random windows, a seeded permutation of the windows per epoch shared out among the ranks
+    train_sampler = EpochSampler(os.path.getsize(train_path) // 2, block_size, batch_size, 1337, ddp_rank if ddp else 0, ddp_world_size)
+# the batches a builder returns are overwritten two calls later, so estimate_loss (get_batch) reads
+# through builders of its own and never touches the batch the training loop holds for its next micro step
+batch_builders = {split: BatchBuilder(os.path.join(data_dir, f'{split}.bin'), batch_size, block_size, device) for split in ('train', 'val')}
 def get_batch(split):
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+    return batch_builders[split]()
+
+# the training stream, the train batches can come from background threads instead (created before
+# the training loop, after the sampler cursor is restored)
+train_builder = BatchBuilder(train_path, batch_size, block_size, device, sampler=train_sampler)
+train_loader = None
+def get_train_batch():
+    return next(train_loader) if train_loader else train_builder()
+
+def train_batches_trained():
+    # batches of the training stream this run has trained on, all drawn ones but the X, Y held for the next micro step
+    return (train_loader or train_builder).k - 1
 
 # -----------------------------------------------------------------------------
 # Model init
@@ -139,14 +164,17 @@ best_val_loss = 1e9
 
 meta_path = os.path.join(data_dir, 'meta.pkl')
 meta_vocab_size = None
+meta_token_ids = None # GPT-2 ids of a dataset with a compacted vocab, see data/shakespeare/prepare.py
 if os.path.exists(meta_path):
     with open(meta_path, 'rb') as f:
         meta = pickle.load(f)
     meta_vocab_size = meta['vocab_size']
+    meta_token_ids = meta.get('token_ids')
     print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
 
-model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
-                  bias=bias, vocab_size=None, dropout=dropout)
+model_args = dict(n_layer=n_layer, n_head=n_head, n_kv_head=n_kv_head, n_embd=n_embd, block_size=block_size,
+                  bias=bias, vocab_size=None, dropout=dropout, attn_block_size=attn_block_size,
+                  activation_checkpointing=activation_checkpointing, loss_chunk_size=loss_chunk_size)
 
 if init_from == 'scratch':
     print("Initializing a new model from scratch")
@@ -155,6 +183,16 @@ if init_from == 'scratch':
     model_args['vocab_size'] = meta_vocab_size if meta_vocab_size is not None else 50304
     gptconf = GPTConfig(**model_args)
     model = GPT(gptconf)
+elif init_from == 'resume' and eval_only and find_checkpoint(out_dir) == 'ckpt.mmap':
+    # evaluation doesn't need the optimizer state, only map the weights exported by export_mmap.py
+    print(f"Evaluating the memory-mapped checkpoint in {out_dir}")
+    model, checkpoint = load_mmap_model(os.path.join(out_dir, 'ckpt.mmap'), 'cpu')
+    for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
+        model_args[k] = checkpoint['model_args'][k]
+    for k in ['n_kv_head', 'head_size', 'mlp_hidden']:
+        model_args[k] = checkpoint['model_args'].get(k, 0) # older checkpoints don't have these
+    iter_num = checkpoint['iter_num'] or 0
+    best_val_loss = checkpoint['best_val_loss'] or 1e9
 elif init_from == 'resume':
     print(f"Resuming training from {out_dir}")
     ckpt_path = os.path.join(out_dir, 'ckpt.pt')
@@ -162,6 +200,8 @@ elif init_from == 'resume':
     checkpoint_model_args = checkpoint['model_args']
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
+    for k in ['n_kv_head', 'head_size', 'mlp_hidden']:
+        model_args[k] = checkpoint_model_args.get(k, 0) # older checkpoints don't have these
     gptconf = GPTConfig(**model_args)
     model = GPT(gptconf)
     state_dict = checkpoint['model']
@@ -174,9 +214,10 @@ elif init_from == 'resume':
     best_val_loss = checkpoint['best_val_loss']
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
-    override_args = dict(dropout=dropout)
-    model = GPT.from_pretrained(init_from, override_args)
-    for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
+    override_args = dict(dropout=dropout, attn_block_size=attn_block_size, activation_checkpointing=activation_checkpointing,
+                         loss_chunk_size=loss_chunk_size)
+    model = GPT.from_pretrained(init_from, override_args, meta_token_ids)
+    for k in ['n_layer', 'n_head', 'n_kv_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = getattr(model.config, k)
 
 if block_size < model.config.block_size:
@@ -185,12 +226,31 @@ if block_size < model.config.block_size:
 
 model.to(device)
 
+if teacher:
+    # the teacher only runs inference on the training batches, its logits are formed chunk by chunk in the loss
+    if teacher.startswith('gpt2'):
+        # with a compacted vocab the teacher keeps only the rows of the dataset's GPT-2 ids, like the student
+        teacher_model = GPT.from_pretrained(teacher, dict(dropout=0.0), meta_token_ids).to(device).eval()
+    else:
+        from inference import load_model
+        teacher_model, _ = load_model('resume', teacher, device)
+    if meta_token_ids is not None:
+        assert teacher_model.config.vocab_size == meta_vocab_size, \
+            f"the teacher's vocab ({teacher_model.config.vocab_size}) isn't the compacted vocab of {dataset} ({meta_vocab_size})"
+    teacher_model.requires_grad_(False)
+    assert teacher_model.config.block_size >= block_size, "the teacher's block_size is smaller than the student's"
+    student_lm_head = model.lm_head # applied outside the forward by the distillation loss
+    if compile:
+        teacher_model = torch.compile(teacher_model)
+
 # -----------------------------------------------------------------------------
 # optimizer
 scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
 optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
-if init_from == 'resume':
+if init_from == 'resume' and 'optimizer' in checkpoint:
     optimizer.load_state_dict(checkpoint['optimizer'])
+if init_from == 'resume' and train_sampler and 'sampler' in checkpoint:
+    train_sampler.load_state_dict(checkpoint['sampler']) # continue the epoch where the checkpoint left it
 checkpoint = None
 
 if compile:
@@ -228,11 +288,16 @@ def get_lr(it):
 
 # -----------------------------------------------------------------------------
 # training loop
-X, Y = get_batch('train')
+if prefetch:
+    train_loader = PrefetchLoader(train_path, batch_size, block_size, device, 1337 + seed_offset, prefetch_workers, prefetch, train_sampler)
+X, Y = get_train_batch()
 t0 = time.time()
+data_wait = 0.0 # time the loop spent waiting for batches in this iteration
 local_iter_num = 0
 raw_model = model.module if ddp else model
 running_mfu = -1.0
+# peak FLOPS of this device in the dtype the matmuls run in, calibrated once per host
+peak = peak_flops(device, ptdtype if device_type == 'cuda' else torch.float32) if master_process else None
 
 while True:
     lr = get_lr(iter_num) if decay_lr else learning_rate
@@ -242,7 +307,8 @@ while True:
     # evaluate train/val
     if iter_num % eval_interval == 0 and master_process:
         losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+        epoch = f", epoch {train_sampler.epoch(train_batches_trained()):.3f}" if train_sampler else ""
+        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}{epoch}")
 
         # ------------------------------------------------------------------ #
         # NEW: CSV Logging for Training and Validation Loss
@@ -268,6 +334,8 @@ while True:
                     'best_val_loss': best_val_loss,
                     'config': config,
                 }
+                if train_sampler:
+                    checkpoint['sampler'] = train_sampler.state_dict(train_batches_trained())
                 print(f"saving checkpoint to {out_dir}")
                 torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
 
@@ -279,9 +347,14 @@ while True:
         if ddp:
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
         with ctx:
-            logits, loss = model(X, Y)
+            if teacher:
+                loss, _ = distillation_loss(model, student_lm_head, teacher_model, X, Y, distill_temperature, distill_alpha, distill_chunk_size)
+            else:
+                logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps
-        X, Y = get_batch('train')
+        t_data = time.time()
+        X, Y = get_train_batch()
+        data_wait += time.time() - t_data
         scaler.scale(loss).backward()
 
     if grad_clip != 0.0:
@@ -297,10 +370,13 @@ while True:
     t0 = t1
     if iter_num % log_interval == 0 and master_process:
         lossf = loss.item() * gradient_accumulation_steps
+        # throughput of this process, the batch of every micro step is (batch_size, X.size(1))
+        stats = throughput(raw_model.config, batch_size, X.size(1), dt, peak, gradient_accumulation_steps)
         if local_iter_num >= 5:
-            mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
-            running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+            running_mfu = stats['mfu'] if running_mfu == -1.0 else 0.9*running_mfu + 0.1*stats['mfu']
+        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, {stats['tokens_per_sec']:.0f} tokens/sec, "
+              f"{stats['flops_per_sec']/1e12:.2f} TFLOPS, mfu {running_mfu*100:.2f}%, data wait {data_wait*1000:.2f}ms")
+    data_wait = 0.0
 
     iter_num += 1
     local_iter_num += 1
@@ -308,6 +384,8 @@ while True:
     if iter_num > max_iters:
         break
 
+if train_loader:
+    train_loader.close()
 if ddp:
     destroy_process_group()
 